@@ -0,0 +1,54 @@
+# Copyright (c) 2017, Tim Wentzlau
+# Licensed under MIT
+
+"""
+Deferred register writes for drivers that buffer register values.
+
+.. code:: python
+
+    with device.batch():
+        device.set(0, True)
+        device.set(1, False)
+    # the changed registers are written here, once each
+"""
+
+import threading
+from contextlib import contextmanager
+
+class BatchWrites(object):
+    """
+    Mixin for drivers that keep shadow copies of their registers.
+
+    Inside a batch block the driver only updates its shadow registers and
+    remembers which are dirty. When the outermost block exits _flush_writes
+    is called to write each dirty register once. Blocks can be nested.
+
+    The driver calls BatchWrites.__init__ and holds _write_lock while it changes
+    shadow registers or writes them. The lock is held for the whole batch, so
+    writes from other threads wait for the batch to be flushed instead of
+    ending up in it.
+    """
+    def __init__(self):
+        self._batch_depth = 0
+        self._write_lock = threading.RLock()
+
+    @contextmanager
+    def batch(self):
+        """Defer register writes until the end of the with block."""
+        with self._write_lock:
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self._flush_writes()
+
+    @property
+    def batching(self):
+        """True while inside a batch block."""
+        return self._batch_depth > 0
+
+    def _flush_writes(self):
+        """Write the registers that changed during the batch."""
+        raise NotImplementedError
@@ -22,6 +22,7 @@
 #Modified to fit the Kervi device api 
 
 import time
+from contextlib import contextmanager
 from kervi.hal.gpio import IGPIODeviceDriver
 from kervi import hal
 
@@ -127,6 +128,12 @@ class HD44780DeviceDriver(object):
         self._d5 = d5
         self._d6 = d6
         self._d7 = d7
+        # Pins on one I/O expander that supports batch() are written together.
+        device = getattr(rs, "_device", None)
+        if hasattr(device, "batch") and all(getattr(pin, "_device", None) is device for pin in (d4, d5, d6, d7)):
+            self._pin_device = device
+        else:
+            self._pin_device = None
         # Save backlight state.
         self._backlight = backlight
         self._pwm_enabled = enable_pwm
@@ -263,21 +270,32 @@ class HD44780DeviceDriver(object):
         """
         # One millisecond delay to prevent writing too quickly.
         self._delay_microseconds(1000)
-        # Set character / data bit.
-        self._rs.set(char_mode)
-        # Write upper 4 bits.
-        self._d4.set(((value >> 4) & 1) > 0)
-        self._d5.set(((value >> 5) & 1) > 0)
-        self._d6.set(((value >> 6) & 1) > 0)
-        self._d7.set(((value >> 7) & 1) > 0)
+        with self._batch():
+            # Set character / data bit.
+            self._rs.set(char_mode)
+            # Write upper 4 bits.
+            self._d4.set(((value >> 4) & 1) > 0)
+            self._d5.set(((value >> 5) & 1) > 0)
+            self._d6.set(((value >> 6) & 1) > 0)
+            self._d7.set(((value >> 7) & 1) > 0)
         self._pulse_enable()
-        # Write lower 4 bits.
-        self._d4.set((value        & 1) > 0)
-        self._d5.set(((value >> 1) & 1) > 0)
-        self._d6.set(((value >> 2) & 1) > 0)
-        self._d7.set(((value >> 3) & 1) > 0)
+        with self._batch():
+            # Write lower 4 bits.
+            self._d4.set((value        & 1) > 0)
+            self._d5.set(((value >> 1) & 1) > 0)
+            self._d6.set(((value >> 2) & 1) > 0)
+            self._d7.set(((value >> 3) & 1) > 0)
         self._pulse_enable()
 
+    @contextmanager
+    def _batch(self):
+        # One bus write for the data pins of a nibble on I/O expanders.
+        if self._pin_device is None:
+            yield
+        else:
+            with self._pin_device.batch():
+                yield
+
     def create_char(self, location, pattern):
         """Fill one of the first 8 CGRAM locations with custom characters.
         The location parameter should be between 0 and 7 and pattern should
@@ -23,18 +23,32 @@
 
 import time
 import math
-from kervi.hal import I2CGPIODeviceDriver
+from kervi.hal import I2CGPIODeviceDriver, DeviceChannelOutOfBoundsError
 from kervi.hal.gpio import CHANNEL_TYPE_GPIO
+from kervi.devices.polling import DeviceTickThread
+from kervi.devices.batch import BatchWrites
 
 I2CADDR = 0x20
 
-class _MCP230XX(I2CGPIODeviceDriver):
+# IOCON bits
+IOCON_MIRROR = 0x40
+IOCON_ODR    = 0x04
+IOCON_INTPOL = 0x02
+
+class _MCP230XX(I2CGPIODeviceDriver, BatchWrites):
     IODIR    = 0x00
-    GPIO     = 0x12
+    GPINTEN  = 0x04
+    DEFVAL   = 0x06
+    INTCON   = 0x08
+    IOCON    = 0x0A
     GPPU     = 0x0C
+    INTF     = 0x0E
+    INTCAP   = 0x10
+    GPIO     = 0x12
 
     def __init__(self, device_name, num_gpio, address=I2CADDR, bus=0, gpio_id="MCP230XX"):
         I2CGPIODeviceDriver.__init__(self, address, bus, gpio_id)
+        BatchWrites.__init__(self)
         self._num_gpio = num_gpio
         self._device_name = device_name
         self.gpio_bytes = int(math.ceil(num_gpio/8.0))
@@ -42,6 +56,21 @@ class _MCP230XX(I2CGPIODeviceDriver):
         self.iodir = [0x00]*self.gpio_bytes  # Default direction to all inputs.
         self.gppu = [0x00]*self.gpio_bytes  # Default to pullups disabled.
         self.gpio = [0x00]*self.gpio_bytes
+        # Interrupt-on-change configuration, GPINTEN, DEFVAL and INTCON are
+        # consecutive registers and written in one transaction.
+        self.gpinten = [0x00]*self.gpio_bytes
+        self.defval = [0x00]*self.gpio_bytes
+        self.intcon = [0x00]*self.gpio_bytes
+        self._interrupt_callbacks = {}
+        self._interrupt_thread = None
+        self._interrupt_active_high = False
+        # Input listeners share one monitor thread that samples all pins per tick.
+        self._listeners = []
+        self._monitor_thread = None
+        self._last_port = None
+        # Last values written to each register, used to skip redundant writes.
+        self._written = {}
+        self._pending = {}
         # Write current direction and pullup buffer state.
         self._write_iodir()
         self._write_gppu()
@@ -63,9 +92,10 @@ class _MCP230XX(I2CGPIODeviceDriver):
         """
         self._validate_channel(pin)
         # Set bit to 1 for input or 0 for output.
-        self.iodir[int(pin/8)] |= 1 << (int(pin%8))
-        self._write_iodir()
-        self.pullup(pin, pullup)
+        with self._write_lock:
+            self.iodir[int(pin/8)] |= 1 << (int(pin%8))
+            self._write_iodir()
+            self.pullup(pin, pullup)
 
     def define_as_output(self, pin):
         """Set the input or output mode for a specified pin.  Mode should be
@@ -73,8 +103,28 @@ class _MCP230XX(I2CGPIODeviceDriver):
         """
         self._validate_channel(pin)
         # Set bit to 1 for input or 0 for output.
-        self.iodir[int(pin/8)] &= ~(1 << (int(pin%8)))
-        self._write_iodir()
+        with self._write_lock:
+            self.iodir[int(pin/8)] &= ~(1 << (int(pin%8)))
+            self._write_iodir()
+
+    def define_many_as_input(self, pins, pullup=False):
+        """Set a list of pins as inputs and enable or disable their pull-up
+        resistors.  IODIR and GPPU are written at most once each.
+        """
+        [self._validate_channel(pin) for pin in pins]
+        with self._write_lock:
+            for pin in pins:
+                self.iodir[int(pin/8)] |= 1 << (int(pin%8))
+            self._write_iodir()
+            self.pullup_many(dict((pin, pullup) for pin in pins))
+
+    def define_many_as_output(self, pins):
+        """Set a list of pins as outputs with a single IODIR write."""
+        [self._validate_channel(pin) for pin in pins]
+        with self._write_lock:
+            for pin in pins:
+                self.iodir[int(pin/8)] &= ~(1 << (int(pin%8)))
+            self._write_iodir()
 
     def set(self, pin, value):
         """Set the specified pin the provided high/low value.  Value should be
@@ -82,6 +132,34 @@ class _MCP230XX(I2CGPIODeviceDriver):
         """
         self._output_pins({pin: value})
 
+    def set_many(self, pins):
+        """Set multiple pins at once.  Pins should be a dict of pin to value
+        (HIGH/True for 1, LOW/False for 0).  The GPIO register is written once,
+        or not at all if no pin changes.
+        """
+        self._output_pins(pins)
+
+    def write_port(self, mask, value):
+        """Set all pins in mask to the corresponding bits of value, pin 0 is bit 0.
+        Pins outside mask keep their state.  Nothing is written if no pin changes.
+        """
+        if mask >> self._num_gpio:
+            raise DeviceChannelOutOfBoundsError(self.device_name, mask)
+        with self._write_lock:
+            for index in range(self.gpio_bytes):
+                port_mask = (mask >> (8*index)) & 0xFF
+                port_value = (value >> (8*index)) & port_mask
+                self.gpio[index] = (self.gpio[index] & ~port_mask) | port_value
+            self._write_gpio()
+
+    def read_port(self):
+        """Read all pins in one transaction and return them as a bitmask, pin 0 is bit 0."""
+        gpio = self.i2c.read_list(self.GPIO, self.gpio_bytes)
+        value = 0
+        for index in range(self.gpio_bytes):
+            value |= gpio[index] << (8*index)
+        return value
+
     def get(self, pin):
         """Read the specified pin and return GPIO.HIGH/True if the pin is pulled
         high, or GPIO.LOW/False if pulled low.
@@ -95,13 +173,14 @@ class _MCP230XX(I2CGPIODeviceDriver):
         """
         [self._validate_channel(pin) for pin in pins.keys()]
         # Set each changed pin's bit.
-        for pin, value in iter(pins.items()):
-            if value:
-                self.gpio[int(pin/8)] |= 1 << (int(pin%8))
-            else:
-                self.gpio[int(pin/8)] &= ~(1 << (int(pin%8)))
-        # Write GPIO state.
-        self._write_gpio()
+        with self._write_lock:
+            for pin, value in iter(pins.items()):
+                if value:
+                    self.gpio[int(pin/8)] |= 1 << (int(pin%8))
+                else:
+                    self.gpio[int(pin/8)] &= ~(1 << (int(pin%8)))
+            # Write GPIO state.
+            self._write_gpio()
 
     def _input_pins(self, pins):
         """Read multiple pins specified in the given list and return list of pin values
@@ -113,24 +192,192 @@ class _MCP230XX(I2CGPIODeviceDriver):
         # Return True if pin's bit is set.
         return [(gpio[int(pin/8)] & 1 << (int(pin%8))) > 0 for pin in pins]
 
+    def listen(self, pin, callback, polling_time=.1):
+        """Call callback with the new pin value when the pin changes.  All listeners
+        on the device share one monitor that reads the GPIO register once per tick,
+        the tick rate is the lowest polling_time of the registered listeners.
+        """
+        self._add_listener(pin, callback, None, polling_time)
+
+    def listen_rising(self, pin, callback, polling_time=.1):
+        """Call callback when the pin goes high."""
+        self._add_listener(pin, callback, True, polling_time)
+
+    def listen_falling(self, pin, callback, polling_time=.1):
+        """Call callback when the pin goes low."""
+        self._add_listener(pin, callback, False, polling_time)
+
+    def _add_listener(self, pin, callback, edge, polling_time):
+        self._validate_channel(pin)
+        self._listeners.append((pin, callback, edge))
+        if self._monitor_thread is None or not self._monitor_thread.alive:
+            self._last_port = None
+            self._monitor_thread = DeviceTickThread(self._monitor_inputs, polling_time)
+            self._monitor_thread.start_ticking()
+        elif polling_time < self._monitor_thread.interval:
+            self._monitor_thread.interval = polling_time
+
+    def _monitor_inputs(self):
+        """Sample all pins once and notify the listeners of the pins that changed."""
+        port = self.read_port()
+        last_port = self._last_port
+        self._last_port = port
+        if last_port is None:
+            return
+        changed = port ^ last_port
+        if not changed:
+            return
+        for pin, callback, edge in list(self._listeners):
+            if changed & (1 << pin):
+                value = (port & (1 << pin)) > 0
+                if edge is None or edge == value:
+                    callback(value)
+
     def pullup(self, pin, enabled):
         """Turn on the pull-up resistor for the specified pin if enabled is True,
         otherwise turn off the pull-up resistor.
         """
+        self.pullup_many({pin: enabled})
+
+    def pullup_many(self, pins):
+        """Enable or disable the pull-up resistors of multiple pins.  Pins should
+        be a dict of pin to enabled.  GPPU is written at most once.
+        """
+        [self._validate_channel(pin) for pin in pins.keys()]
+        with self._write_lock:
+            for pin, enabled in iter(pins.items()):
+                if enabled:
+                    self.gppu[int(pin/8)] |= 1 << (int(pin%8))
+                else:
+                    self.gppu[int(pin/8)] &= ~(1 << (int(pin%8)))
+            self._write_gppu()
+
+    def configure_interrupt(self, mirror=True, open_drain=False, active_high=False):
+        """Configure the INT output(s) of the chip via IOCON.  When mirror is True
+        INTA and INTB are connected internally so one host pin can watch all pins.
+        The INT output is active low unless active_high is True, open_drain
+        overrides the polarity and lets several chips share one host pin.
+        """
+        iocon = 0x00
+        if mirror:
+            iocon |= IOCON_MIRROR
+        if open_drain:
+            iocon |= IOCON_ODR
+        elif active_high:
+            iocon |= IOCON_INTPOL
+        self.i2c.write8(self.IOCON, iocon)
+        self._interrupt_active_high = active_high and not open_drain
+
+    def enable_interrupt(self, pin, callback, compare_value=None):
+        """Enable interrupt-on-change for the specified pin.  The callback is called
+        with the captured pin value when the interrupt fires.  If compare_value is
+        None the interrupt fires on every change, otherwise it fires when the pin
+        differs from compare_value.
+        """
         self._validate_channel(pin)
-        if enabled:
-            self.gppu[int(pin/8)] |= 1 << (int(pin%8))
-        else:
-            self.gppu[int(pin/8)] &= ~(1 << (int(pin%8)))
-        self._write_gppu()
+        with self._write_lock:
+            index = int(pin/8)
+            bit = 1 << (int(pin%8))
+            if compare_value is None:
+                self.intcon[index] &= ~bit
+            else:
+                self.intcon[index] |= bit
+                if compare_value:
+                    self.defval[index] |= bit
+                else:
+                    self.defval[index] &= ~bit
+            self.gpinten[index] |= bit
+            self._interrupt_callbacks[pin] = callback
+            self._write_interrupt_config()
+
+    def disable_interrupt(self, pin):
+        """Disable interrupt-on-change for the specified pin."""
+        self._validate_channel(pin)
+        with self._write_lock:
+            self.gpinten[int(pin/8)] &= ~(1 << (int(pin%8)))
+            self._interrupt_callbacks.pop(pin, None)
+            self._write_interrupt_config()
+
+    def watch_interrupt(self, int_pin=None, polling_time=.1):
+        """Start dispatching interrupts to the callbacks registered with enable_interrupt.
+        int_pin is a host gpio channel wired to the INT output of the chip, e.g.
+        GPIO["gpio17"].  If no int_pin is given the INTF register is polled every
+        polling_time seconds instead.  As INTCAP latches the pin state at the time
+        of the interrupt short pulses are not lost between polls.
+        Call configure_interrupt first, int_pin listens for the edge that asserts INT.
+        watch_interrupt defines int_pin as input itself, do not call define_as_input
+        on it as that already listens for both edges and the host gpio only allows
+        one listener per pin.
+        """
+        if int_pin is not None:
+            # listen on the host driver, the listen_falling of the channel proxy
+            # is broken. Only the asserting edge, reading INTCAP releases INT again
+            device, channel = int_pin._device, int_pin._channel
+            device.define_as_input(channel, not self._interrupt_active_high)
+            if self._interrupt_active_high:
+                device.listen_rising(channel, self._interrupt_triggered)
+            else:
+                device.listen_falling(channel, self._interrupt_triggered)
+        elif self._interrupt_thread is None or not self._interrupt_thread.alive:
+            self._interrupt_thread = DeviceTickThread(self.handle_interrupt, polling_time)
+            self._interrupt_thread.start_ticking()
+
+    def handle_interrupt(self):
+        """Read INTF and INTCAP in one transaction and call the callbacks of the pins
+        that caused the interrupt.  Reading INTCAP clears the interrupt.  Returns the
+        list of pins that were dispatched.
+        """
+        # INTCAP follows right after INTF in the register map.
+        flags = self.i2c.read_list(self.INTF, 2*self.gpio_bytes)
+        if not any(flags[:self.gpio_bytes]):
+            return []
+        captured = flags[self.gpio_bytes:]
+        fired = []
+        for pin, callback in list(self._interrupt_callbacks.items()):
+            bit = 1 << (int(pin%8))
+            if flags[int(pin/8)] & bit:
+                fired.append(pin)
+                callback((captured[int(pin/8)] & bit) > 0)
+        return fired
+
+    def _interrupt_triggered(self, *args):
+        self.handle_interrupt()
+
+    def _write_interrupt_config(self):
+        """Write the GPINTEN, DEFVAL and INTCON buffers in one transaction."""
+        self._write_buffer(self.GPINTEN, self.gpinten + self.defval + self.intcon)
+
+    def _write_buffer(self, register, data):
+        """Write data to register unless it is what was last written there.
+        Inside a batch the write is deferred until the batch ends.
+        """
+        with self._write_lock:
+            if self.batching:
+                self._pending[register] = list(data)
+                return
+            if self._written.get(register) == data:
+                return
+            self.i2c.write_list(register, data)
+            self._written[register] = list(data)
+
+    def _flush_writes(self):
+        # Output latches are written before IODIR so pins switched to output
+        # start with their new value.
+        with self._write_lock:
+            pending = self._pending
+            self._pending = {}
+            for register in (self.GPPU, self.GPIO, self.IODIR, self.GPINTEN):
+                if register in pending:
+                    self._write_buffer(register, pending[register])
 
     def _write_gpio(self, gpio=None):
         """Write the specified byte value to the GPIO registor.  If no value
-        specified the current buffered value will be written.
+        specified the current buffered value will be written.  The write is
+        skipped when the register already holds the value.
         """
         if gpio is not None:
             self.gpio = gpio
-        self.i2c.write_list(self.GPIO, self.gpio)
+        self._write_buffer(self.GPIO, self.gpio)
 
     def _write_iodir(self, iodir=None):
         """Write the specified byte value to the IODIR registor.  If no value
@@ -138,7 +385,7 @@ class _MCP230XX(I2CGPIODeviceDriver):
         """
         if iodir is not None:
             self.iodir = iodir
-        self.i2c.write_list(self.IODIR, self.iodir)
+        self._write_buffer(self.IODIR, self.iodir)
 
     def _write_gppu(self, gppu=None):
         """Write the specified byte value to the GPPU registor.  If no value
@@ -146,14 +393,20 @@ class _MCP230XX(I2CGPIODeviceDriver):
         """
         if gppu is not None:
             self.gppu = gppu
-        self.i2c.write_list(self.GPPU, self.gppu)
+        self._write_buffer(self.GPPU, self.gppu)
 
 class MCP23017DeviceDriver(_MCP230XX):
     """MCP23017-based GPIO class with 16 GPIO pins."""
     # Define number of pins and registor addresses.
     IODIR = 0x00
-    GPIO = 0x12
+    GPINTEN = 0x04
+    DEFVAL = 0x06
+    INTCON = 0x08
+    IOCON = 0x0A
     GPPU = 0x0C
+    INTF = 0x0E
+    INTCAP = 0x10
+    GPIO = 0x12
 
     def __init__(self, address=0x20, bus=0):
         _MCP230XX.__init__(self, "MCP23017", 16, address, bus)
@@ -162,8 +415,14 @@ class MCP23008DeviceDriver(_MCP230XX):
     """MCP23008-based GPIO class with 8 GPIO pins."""
     # Define number of pins and registor addresses.
     IODIR = 0x00
-    GPIO = 0x09
+    GPINTEN = 0x02
+    DEFVAL = 0x03
+    INTCON = 0x04
+    IOCON = 0x05
     GPPU = 0x06
+    INTF = 0x07
+    INTCAP = 0x08
+    GPIO = 0x09
 
     def __init__(self, address=0x20, bus=0):
         _MCP230XX.__init__(self, "MCP23008", 8, address, bus)
@@ -21,6 +21,8 @@ SOFTWARE.'''
 
 from kervi.hal import I2CGPIODeviceDriver
 from kervi.hal.gpio import CHANNEL_TYPE_GPIO
+from kervi.devices.polling import DeviceTickThread, clock
+from kervi.devices.batch import BatchWrites
 
 IN = 1
 OUT = 0
@@ -28,12 +30,16 @@ HIGH = True
 LOW = False
 
 
-class PCF8574DeviceDriver(I2CGPIODeviceDriver):
+class PCF8574DeviceDriver(I2CGPIODeviceDriver, BatchWrites):
     """
     Class to represent a PCF8574 or PCF8574A GPIO extender.
+
+    If cache_time is larger than 0 a port read is reused for that many seconds,
+    so reading several pins in the same control loop tick costs one bus read.
     """
-    def __init__(self, address=0x27, bus=None, gpio_id="PCF8574"):
+    def __init__(self, address=0x27, bus=None, gpio_id="PCF8574", cache_time=0):
         I2CGPIODeviceDriver.__init__(self, address, bus, gpio_id)
+        BatchWrites.__init__(self)
         self.__name__ = \
             "PCF8574" if address in range(0x20, 0x28) else \
             "PCF8574A" if address in range(0x38, 0x40) else \
@@ -44,6 +50,14 @@ class PCF8574DeviceDriver(I2CGPIODeviceDriver):
         # Buffer register values so they can be changed without reading.
         self.iodir = 0xFF  # Default direction to all inputs is in
         self.gpio = 0x00
+        self.cache_time = cache_time
+        self._cached_pins = None
+        self._cached_at = 0
+        self._listeners = []
+        self._last_pins = None
+        self._int_pin = None
+        self._monitor_thread = None
+        self._written_pins = None
         self._write_pins()
 
     def _get_channel_type(self, channel):
@@ -66,20 +80,23 @@ class PCF8574DeviceDriver(I2CGPIODeviceDriver):
     def define_as_input(self, channel, pull=None):
         pin = self._map_pin(channel)
         self._validate_channel(pin)
-        self.iodir = self._bit2(self.iodir, pin, IN)
-        self._write_pins()
+        with self._write_lock:
+            self.iodir = self._bit2(self.iodir, pin, IN)
+            self._write_pins()
 
     def define_as_output(self, channel):
         pin = self._map_pin(channel)
         self._validate_channel(pin)
-        self.iodir = self._bit2(self.iodir, pin, OUT)
-        self._write_pins()
+        with self._write_lock:
+            self.iodir = self._bit2(self.iodir, pin, OUT)
+            self._write_pins()
 
     def set(self, channel, value):
         pin = self._map_pin(channel)
         self._validate_channel(pin)
-        self.gpio = self._bit2(self.gpio, pin, bool(value))
-        self._write_pins()
+        with self._write_lock:
+            self.gpio = self._bit2(self.gpio, pin, bool(value))
+            self._write_pins()
 
     def get(self, channel):
         pin = self._map_pin(channel)
@@ -87,8 +104,115 @@ class PCF8574DeviceDriver(I2CGPIODeviceDriver):
         inp = self._read_pins()
         return bool(inp & (1<<pin))
 
+    def read_all(self, as_dict=False):
+        """
+        Read all input pins in one bus read.
+
+        :param as_dict: Return a dict of pin to bool instead of a bitmask.
+        :type as_dict: ``bool``
+
+        :return: Bitmask of the input pins, pin 0 is bit 0. Output pins read as 0.
+        """
+        inp = self._read_pins()
+        if as_dict:
+            return dict((pin, bool(inp & (1<<pin))) for pin in range(8))
+        return inp
+
+    def listen(self, channel, callback, polling_time=.1):
+        """
+        Call callback with the new value when the pin changes.
+
+        When the INT output is watched via watch_interrupt the port is only read
+        when INT is asserted. Otherwise all listeners share one monitor that reads
+        the port once every polling_time seconds.
+        """
+        pin = self._map_pin(channel)
+        self._validate_channel(pin)
+        self._listeners.append((pin, callback))
+        if self._int_pin is None:
+            if self._monitor_thread is None or not self._monitor_thread.alive:
+                self._last_pins = None
+                self._monitor_thread = DeviceTickThread(self._port_changed, polling_time)
+                self._monitor_thread.start_ticking()
+            elif polling_time < self._monitor_thread.interval:
+                self._monitor_thread.interval = polling_time
+
+    def watch_interrupt(self, int_pin, polling_time=None):
+        """
+        Read the port and notify listeners only when the INT output of the chip
+        is asserted (low). INT is asserted when an input changes and released
+        when the port is read, so an idle port causes no bus traffic.
+
+        :param int_pin: Host gpio channel wired to INT, e.g. GPIO["gpio17"].
+            It is defined as input with pull-up here. Do not call define_as_input
+            on it, that already listens for both edges and the host gpio only
+            allows one listener per pin.
+
+        :param polling_time: If set the level of int_pin is polled with this
+            interval instead of waiting for a falling edge.
+        :type polling_time: ``float``
+        """
+        if self._monitor_thread:
+            self._monitor_thread.stop()
+        # use the host driver, the get and listen_falling of the channel
+        # proxy are broken
+        self._int_pin = (int_pin._device, int_pin._channel)
+        device, channel = self._int_pin
+        device.define_as_input(channel, True)
+        self._last_pins = self.i2c.read_raw8()
+        if polling_time:
+            self._monitor_thread = DeviceTickThread(self._poll_int_pin, polling_time)
+            self._monitor_thread.start_ticking()
+        else:
+            device.listen_falling(channel, self._interrupt_triggered)
+
+    def _poll_int_pin(self):
+        device, channel = self._int_pin
+        if not device.get(channel):
+            self._port_changed()
+
+    def _interrupt_triggered(self, *args):
+        self._port_changed()
+
+    def _port_changed(self):
+        """Read the port once and call the listeners of the pins that changed."""
+        pins = self.i2c.read_raw8()
+        self._cached_pins = pins
+        self._cached_at = clock()
+        last_pins = self._last_pins
+        self._last_pins = pins
+        if last_pins is None:
+            return
+        changed = (pins ^ last_pins) & self.iodir
+        if not changed:
+            return
+        for pin, callback in list(self._listeners):
+            if changed & (1<<pin):
+                callback(bool(pins & (1<<pin)))
+
+    def invalidate_cache(self):
+        """Force the next read to go to the bus."""
+        self._cached_pins = None
+
     def _write_pins(self):
-        self.i2c.write_raw8(self.gpio | self.iodir)
+        with self._write_lock:
+            if self.batching:
+                return
+            pins = self.gpio | self.iodir
+            if pins == self._written_pins:
+                return
+            self._cached_pins = None
+            self.i2c.write_raw8(pins)
+            self._written_pins = pins
+
+    def _flush_writes(self):
+        self._write_pins()
 
     def _read_pins(self):
+        if self.cache_time > 0:
+            now = clock()
+            if self._cached_pins is None or now - self._cached_at >= self.cache_time:
+                self._cached_pins = self.i2c.read_raw8()
+                self._cached_at = now
+            return self._cached_pins & self.iodir
         return self.i2c.read_raw8() & self.iodir
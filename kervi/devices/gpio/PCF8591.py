@@ -2,24 +2,276 @@
 # Licensed under MIT
 
 import time
+import math
+import threading
+from array import array
 from kervi.hal import I2CGPIODeviceDriver, DeviceChannelOutOfBoundsError, DACValueOutOfBoundsError
-from kervi.hal import ChannelPollingThread
 from kervi.hal.gpio import CHANNEL_TYPE_GPIO, CHANNEL_TYPE_ANALOG_IN, CHANNEL_TYPE_ANALOG_OUT
 from kervi.core.utility.thread import KerviThread
 from kervi import spine
+from kervi.devices.polling import DeviceTickThread, clock
 AIN0 = 0
 AIN1 = 1
 AIN2 = 2
 AIN3 = 3
 AOUT = 4
 
+# Control byte flags
+AUTO_INCREMENT = 0x04
+DAC_ENABLE = 0x40
+
+# Max bytes in one i2c block read or write
+I2C_BLOCK_MAX = 32
+
+# Default i2c clock in Hz, used to pace DAC samples inside a block write
+I2C_BUS_SPEED = 100000
+
+def sine_table(size, amplitude=1.0, offset=0.5):
+    """Return one period of a sine wave as size DAC values between 0 and 1."""
+    return [offset + amplitude / 2.0 * math.sin(2 * math.pi * i / size) for i in range(size)]
+
+def ramp_table(size, start=0.0, end=1.0):
+    """Return a linear ramp from start to end as size DAC values between 0 and 1."""
+    if size == 1:
+        return [start]
+    return [start + (end - start) * i / (size - 1.0) for i in range(size)]
+
+class PCF8591Stream(object):
+    """
+    Continuous acquisition of one or more ADC channels into a preallocated ring buffer.
+
+    Each tick reads a block of conversions in one transaction, a single channel is
+    read repeatedly and several channels are read as auto-increment frames of
+    AIN0-AIN3. Conversions inside a block are taken back to back at bus speed,
+    blocks are paced so the average rate matches the requested rate, so samples
+    arrive in bursts and are not evenly spaced.
+    With decimation > 1 that many conversions are averaged into one sample.
+
+    Each time stamp is when the last conversion of the sample was clocked out,
+    estimated from the end of the block read and the byte time at bus_speed.
+
+    Samples are raw 8 bit values stored in samples (one row of len(channels) values
+    per sample) with a matching monotonic time stamp in timestamps. Consume them
+    with read(), by iterating over the stream or with a callback that is called
+    from the sampling thread with the new (timestamp, values) tuples.
+    """
+    def __init__(self, device, channels, rate, buffer_size, decimation=1, callback=None, bus_speed=I2C_BUS_SPEED):
+        for channel in channels:
+            device._check_channel_no(channel)
+        self._device = device
+        self.channels = list(channels)
+        self.rate = rate
+        self.buffer_size = buffer_size
+        self.decimation = decimation
+        self.callback = callback
+        self.samples = array('B', [0]) * (buffer_size * len(self.channels))
+        self.timestamps = array('d', [0.0]) * buffer_size
+        self.count = 0
+        self.overruns = 0
+        self._read_count = 0
+        self._sums = [0] * len(self.channels)
+        self._summed = 0
+        # a byte is 9 clocks
+        self._byte_time = 9.0 / bus_speed
+        self._condition = threading.Condition()
+
+        if len(self.channels) == 1:
+            self._offsets = [0]
+            self._frame_size = 1
+            self._control = self.channels[0]
+        else:
+            self._offsets = self.channels
+            self._frame_size = 4
+            self._control = AIN0 | AUTO_INCREMENT
+        max_frames = (I2C_BLOCK_MAX - 1) // self._frame_size
+        conversion_rate = float(rate * decimation)
+        self._block_frames = max(1, min(max_frames, int(conversion_rate / 100)))
+        self._thread = DeviceTickThread(self._sample, self._block_frames / conversion_rate)
+
+    @property
+    def running(self):
+        return self._thread.alive
+
+    def start(self):
+        self._thread.start_ticking()
+
+    def stop(self):
+        self._thread.stop()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _sample(self):
+        control = self._control | self._device._dac_enabled
+        data = self._device.i2c.read_list(control, 1 + self._block_frames * self._frame_size)
+        now = clock()
+        last_byte = len(data) - 1
+
+        channel_count = len(self.channels)
+        sums = self._sums
+        first_new = self.count
+        for frame in range(self._block_frames):
+            base = 1 + frame * self._frame_size
+            for index, offset in enumerate(self._offsets):
+                sums[index] += data[base + offset]
+            self._summed += 1
+            if self._summed == self.decimation:
+                position = self.count % self.buffer_size
+                row = position * channel_count
+                for index in range(channel_count):
+                    self.samples[row + index] = (sums[index] + self.decimation // 2) // self.decimation
+                    sums[index] = 0
+                frame_end = base + self._frame_size - 1
+                self.timestamps[position] = now - (last_byte - frame_end) * self._byte_time
+                self._summed = 0
+                self.count += 1
+
+        if self.count != first_new:
+            with self._condition:
+                self._condition.notify_all()
+            if self.callback:
+                self.callback(self._frames(first_new, self.count))
+
+    def _frames(self, first, last):
+        channel_count = len(self.channels)
+        frames = []
+        for index in range(first, last):
+            position = index % self.buffer_size
+            row = position * channel_count
+            frames.append((self.timestamps[position], tuple(self.samples[row:row + channel_count])))
+        return frames
+
+    def read(self, timeout=None):
+        """
+        Return the samples acquired since the last call as a list of
+        (timestamp, values) tuples. Waits up to timeout seconds for new samples.
+        Samples that were overwritten before they were read are counted in overruns.
+        """
+        with self._condition:
+            if self._read_count == self.count and self.running:
+                self._condition.wait(timeout)
+            last = self.count
+        first = self._read_count
+        if last - first > self.buffer_size:
+            self.overruns += last - first - self.buffer_size
+            first = last - self.buffer_size
+        self._read_count = last
+        frames = self._frames(first, last)
+        # the ring is copied while the sampler writes it, drop the rows that
+        # were overwritten meanwhile. The row at self.count is being written.
+        stale = min(len(frames), self.count - self.buffer_size + 1 - first)
+        if stale > 0:
+            self.overruns += stale
+            frames = frames[stale:]
+        return frames
+
+    def __iter__(self):
+        while self.running:
+            for frame in self.read(1):
+                yield frame
+
+class PCF8591Waveform(object):
+    """
+    Plays a precomputed sample table on the DAC.
+
+    The table is converted to bytes and split into chunks once. Each tick writes
+    one chunk in a single transaction, ticks are deadline scheduled at
+    chunk_size / sample_rate. The DAC takes a new value for every byte on the
+    bus, so each sample is repeated for as many bytes as fit in its duration at
+    bus_speed and a transaction lasts one tick. Slow waveforms are written one
+    sample per tick and the DAC holds it until the next tick. If the bus can not
+    keep up with the sample rate every stride'th sample of the table is played.
+    """
+    def __init__(self, device, table, frequency, chunk_size=None, loop=True, bus_speed=I2C_BUS_SPEED):
+        samples = bytearray(int(round(max(0.0, min(1.0, value)) * 255)) for value in table)
+        # a byte is 9 clocks, a block write adds address and control byte to the samples
+        byte_rate = bus_speed / 9.0
+        block_bytes = I2C_BLOCK_MAX + 1
+        table_samples = samples
+        stride = 0
+        while True:
+            stride += 1
+            samples = table_samples[::stride]
+            sample_rate = float(frequency * len(samples))
+            bytes_per_sample = byte_rate / sample_rate
+            max_chunk = max(1, min(int(block_bytes / bytes_per_sample), len(samples)))
+            # stop when a chunk has room for the samples and the two extra bytes
+            if max_chunk == 1 or max_chunk * bytes_per_sample >= max_chunk + 2:
+                break
+        if chunk_size is None or chunk_size > max_chunk or chunk_size * bytes_per_sample < chunk_size + 2:
+            chunk_size = max_chunk
+        chunk_size = max(1, chunk_size)
+        self._device = device
+        self.frequency = frequency
+        self.chunk_size = chunk_size
+        self.stride = stride
+        self.loop = loop
+        self._chunks = [
+            self._stretch(chunk, bytes_per_sample)
+            for chunk in self._split(samples, chunk_size, loop)
+        ]
+        self._position = 0
+        self._thread = DeviceTickThread(self._play_chunk, chunk_size / sample_rate)
+
+    @staticmethod
+    def _stretch(chunk, bytes_per_sample):
+        """Repeat the samples of a chunk so the transaction lasts as long as the
+        chunk plays, a single sample is written once and held."""
+        size = len(chunk)
+        if size == 1:
+            return list(chunk)
+        total = max(size, int(round(size * bytes_per_sample)) - 2)
+        stretched = []
+        for index, value in enumerate(chunk):
+            count = int(round((index + 1) * total / float(size))) - int(round(index * total / float(size)))
+            stretched += [value] * count
+        return stretched
+
+    @staticmethod
+    def _split(samples, chunk_size, loop):
+        """Split samples in chunks. When looping the chunks wrap around the end
+        of the table until they line up with its start again."""
+        chunks = []
+        size = len(samples)
+        if not loop:
+            for start in range(0, size, chunk_size):
+                chunks.append(list(samples[start:start + chunk_size]))
+            return chunks
+        wrapped = samples * (chunk_size // size + 2)
+        start = 0
+        while True:
+            chunks.append(list(wrapped[start:start + chunk_size]))
+            start = (start + chunk_size) % size
+            if start == 0:
+                return chunks
+
+    @property
+    def running(self):
+        return self._thread.alive
+
+    def start(self):
+        self._thread.start_ticking()
+
+    def stop(self):
+        self._thread.stop()
+
+    def _play_chunk(self):
+        self._device.i2c.write_list(DAC_ENABLE, self._chunks[self._position])
+        self._position += 1
+        if self._position == len(self._chunks):
+            self._position = 0
+            if not self.loop:
+                self.stop()
+
 class PCF8591Driver(I2CGPIODeviceDriver):
 
     # Constructor
-    def __init__(self, address = 0x48, bus=0, gpio_id="PCF8591"):
+    def __init__(self, address = 0x48, bus=0, gpio_id="PCF8591", deadband=0.0):
         I2CGPIODeviceDriver.__init__(self, address, bus, gpio_id)
         self._dac_enabled = 0x00
+        self.deadband = deadband
+        # [channel, callback, deadband in counts, last reported reading]
         self._listeners = []
+        self._listen_thread = None
 
     def _get_channel_type(self, channel):
         if channel in ["AIN1", "AIN2", "AIN3", "AIN4", "AOUT"]:
@@ -44,12 +296,91 @@ class PCF8591Driver(I2CGPIODeviceDriver):
         reading = self.i2c.read_raw8() 
         return reading / 255.0
 
+    def read_all(self, raw=False):
+        """
+        Read all four ADC channels in one transaction using the auto-increment flag.
+        The first byte of a read holds the previous conversion and is dropped.
+
+        :param raw: Return the 8 bit readings instead of values between 0 and 1.
+        :type raw: ``bool``
+
+        :return: List with the readings of AIN0 to AIN3.
+        """
+        readings = self.i2c.read_list(AIN0 | AUTO_INCREMENT | self._dac_enabled, 5)[1:]
+        if raw:
+            return list(readings)
+        return [reading / 255.0 for reading in readings]
+
+    def stream(self, channels=None, rate=1000, buffer_size=1024, decimation=1, callback=None, bus_speed=I2C_BUS_SPEED):
+        """
+        Start continuous sampling of one or more ADC channels into a ring buffer.
+        The stream reads the bus from its own thread, avoid calling get
+        while it is running.
+
+        :param channels: ADC channels to sample, default is all four.
+        :type channels: ``list``
+
+        :param rate: Samples per second per channel after decimation.
+        :type rate: ``int``
+
+        :param buffer_size: Number of samples kept in the ring buffer.
+        :type buffer_size: ``int``
+
+        :param decimation: Number of conversions averaged into each sample.
+        :type decimation: ``int``
+
+        :param callback: Called with a list of new (timestamp, values) tuples after each block.
+
+        :param bus_speed: Clock of the i2c bus in Hz, used for the time stamps.
+        :type bus_speed: ``int``
+
+        :return: The running ``PCF8591Stream``.
+        """
+        if channels is None:
+            channels = [AIN0, AIN1, AIN2, AIN3]
+        sampler = PCF8591Stream(self, channels, rate, buffer_size, decimation, callback, bus_speed)
+        sampler.start()
+        return sampler
+
     def set(self, channel, state):
         """Set DAC value and enable output"""
         checked_val = self._check_dac_val(channel, state)
         self._dac_enabled = 0x40
         self.i2c.write8(self._dac_enabled, checked_val * 255)
 
+    def play(self, table, frequency, chunk_size=None, loop=True, bus_speed=I2C_BUS_SPEED):
+        """
+        Play a waveform on the DAC.
+
+        .. code:: python
+
+            wave = adc.play(sine_table(64), 10)
+            ...
+            wave.stop()
+
+        :param table: One period of DAC values between 0 and 1, see sine_table and ramp_table.
+        :type table: ``list``
+
+        :param frequency: Number of times per second the table is played.
+        :type frequency: ``float``
+
+        :param chunk_size: Highest number of table samples written per transaction,
+            default is as many as fit in one block write.
+        :type chunk_size: ``int``
+
+        :param loop: Repeat the table until stop is called.
+        :type loop: ``bool``
+
+        :param bus_speed: Clock of the i2c bus in Hz.
+        :type bus_speed: ``int``
+
+        :return: The running ``PCF8591Waveform``.
+        """
+        self._dac_enabled = DAC_ENABLE
+        waveform = PCF8591Waveform(self, table, frequency, chunk_size, loop, bus_speed)
+        waveform.start()
+        return waveform
+
     def define_as_input(self, channel, pullup=False):
         self._check_channel_no(channel)
 
@@ -57,8 +388,40 @@ class PCF8591Driver(I2CGPIODeviceDriver):
         if not channel == 0:
             raise DeviceChannelOutOfBoundsError(self.device_name, channel)
 
-    def listen(self, channel, callback, polling_time=.1):
-        self._listeners += [ChannelPollingThread(channel, self, callback, polling_time)]
+    def listen(self, channel, callback, polling_time=.1, deadband=None):
+        """
+        Call callback with the channel value when it moves more than deadband
+        from the last reported value. All listeners share one polling thread that
+        reads the subscribed channels in one transaction per tick.
+
+        :param deadband: Change between 0 and 1 needed to report a new value,
+            default is the deadband passed to the driver.
+        :type deadband: ``float``
+        """
+        self._check_channel_no(channel)
+        if deadband is None:
+            deadband = self.deadband
+        self._listeners.append([channel, callback, deadband * 255, None])
+        if self._listen_thread is None or not self._listen_thread.alive:
+            self._listen_thread = DeviceTickThread(self._poll_listeners, polling_time)
+            self._listen_thread.start_ticking()
+        elif polling_time < self._listen_thread.interval:
+            self._listen_thread.interval = polling_time
+
+    def _poll_listeners(self):
+        listeners = list(self._listeners)
+        channels = set(listener[0] for listener in listeners)
+        if len(channels) == 1:
+            channel = channels.pop()
+            readings = {channel: self.i2c.read_list(channel | self._dac_enabled, 2)[1]}
+        else:
+            readings = self.read_all(raw=True)
+        for listener in listeners:
+            channel, callback, deadband, last_reading = listener
+            reading = readings[channel]
+            if last_reading is None or abs(reading - last_reading) > deadband:
+                listener[3] = reading
+                callback(reading / 255.0)
 
     # Enable DAC output
     def enable_dac(self):
@@ -67,8 +430,8 @@ class PCF8591Driver(I2CGPIODeviceDriver):
 
     # Disable DAC output
     def disable_dac(self):
-        self.__dac_enabled = 0x00
-        self.i2c.write_raw8(self.__dac_enabled)
+        self._dac_enabled = 0x00
+        self.i2c.write_raw8(self._dac_enabled)
 
     # Check if ADC channel number is within bounds
     def _check_channel_no(self, chan):
@@ -1,6 +1,7 @@
 from kervi.hal.motor_controller import MotorControllerBoard, DCMotorControllerBase, StepperMotorControllerBase
+from kervi.devices.motors.ramp import RampedDCMotors
 
-class _DCMotorController(DCMotorControllerBase):
+class _DCMotorController(RampedDCMotors, DCMotorControllerBase):
     def __init__(self, controller_id, ena, in1, in2, enb, in3, in4):
         DCMotorControllerBase.__init__(self, controller_id, "LN298", 2)
 
@@ -1,52 +1,308 @@
+import os
+import json
+import math
+import threading
 from kervi.devices.pwm.PCA9685 import PCA9685DeviceDriver
+from kervi.devices.polling import DeviceTickThread, clock
 from kervi.hal.motor_controller import MotorControllerBoard, ServoMotor, ServoMotorControllerBase
 
 # Configure min and max servo pulse lengths
 servo_min = 150  # Min pulse length out of 4096
 servo_max = 600  # Max pulse length out of 4096
 
-# Helper function to make setting a servo pulse width simpler.
+# Default calibration in microseconds, matches the 200/400/600 counts
+# previously used at 60 Hz, the chip runs at 59.84 Hz with prescale 101.
+DEFAULT_MIN_PULSE = 816
+DEFAULT_CENTER_PULSE = 1632
+DEFAULT_MAX_PULSE = 2448
 
+# Frequency used for the pulse tables until the PWM device knows its frequency
+DEFAULT_FREQUENCY = 60
+
+# Velocity profiles for servo moves
+TRAPEZOID = "trapezoid"
+S_CURVE = "s_curve"
+
+# Part of a trapezoid move spent accelerating and the same part decelerating
+TRAPEZOID_RAMP = 0.25
+
+def _trapezoid(progress):
+    peak = 1.0 / (1.0 - TRAPEZOID_RAMP)
+    if progress < TRAPEZOID_RAMP:
+        return 0.5 * peak / TRAPEZOID_RAMP * progress * progress
+    if progress <= 1.0 - TRAPEZOID_RAMP:
+        return 0.5 * peak * TRAPEZOID_RAMP + peak * (progress - TRAPEZOID_RAMP)
+    rest = 1.0 - progress
+    return 1.0 - 0.5 * peak / TRAPEZOID_RAMP * rest * rest
+
+def _s_curve(progress):
+    # smootherstep, continuous acceleration at start and end
+    return progress * progress * progress * (progress * (progress * 6 - 15) + 10)
+
+# profile function and ratio between its peak and average velocity
+_PROFILES = {
+    TRAPEZOID: (_trapezoid, 1.0 / (1.0 - TRAPEZOID_RAMP)),
+    S_CURVE: (_s_curve, 1.875)
+}
+
+class _ServoMove(object):
+    def __init__(self, start_time, duration, start, target, profile, done):
+        self.start_time = start_time
+        self.duration = duration
+        self.start = start
+        self.target = target
+        self.profile = profile
+        self.done = done
+
+class ServoMotionEngine(object):
+    """
+    Moves servos along velocity profiles from one fixed rate thread.
+
+    Servos passed in the same call to move start together and arrive together,
+    also when they are on different boards. Each tick writes the new positions
+    of each board with one call to set_pwm_many, so neighbouring channels go out
+    as one register burst. The thread only runs while servos are moving.
+    """
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self._moves = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def move(self, targets, duration=None, max_speed=100, profile=TRAPEZOID):
+        """
+        Start a coordinated move.
+
+        :param targets: Dict of (servo controller, channel) to target position (-100 to 100).
+        :type targets: ``dict``
+
+        :param duration: Duration of the move in seconds. If not given it is
+            calculated from max_speed and the longest distance to move.
+        :type duration: ``float``
+
+        :param max_speed: Peak speed in position units per second used to calculate duration.
+        :type max_speed: ``float``
+
+        :param profile: TRAPEZOID or S_CURVE.
+
+        :return: ``threading.Event`` that is set when all servos have arrived.
+        """
+        profile_function, peak_ratio = _PROFILES[profile]
+        done = threading.Event()
+        with self._lock:
+            starts = {}
+            for key in targets:
+                controller, channel = key
+                start = controller._positions[channel]
+                starts[key] = targets[key] if start is None else start
+            if duration is None:
+                distance = max([abs(targets[key] - starts[key]) for key in targets] + [0])
+                duration = distance * peak_ratio / float(max_speed)
+            start_time = clock()
+            for key in targets:
+                self._moves[key] = _ServoMove(start_time, duration, starts[key], targets[key], profile_function, done)
+            if not targets:
+                done.set()
+            if self._thread is None:
+                self._thread = DeviceTickThread(self._tick, self.interval)
+            if targets:
+                self._thread.start_ticking()
+        return done
+
+    def cancel(self, controller, channel=None):
+        """Stop moves of a servo or of all servos on a controller at their current position."""
+        with self._lock:
+            for key in list(self._moves):
+                if key[0] is controller and (channel is None or key[1] == channel):
+                    move = self._moves.pop(key)
+                    self._check_done(move.done)
+
+    def _check_done(self, done):
+        for move in self._moves.values():
+            if move.done is done:
+                return
+        done.set()
+
+    def _tick(self):
+        now = clock()
+        with self._lock:
+            controllers = set(key[0] for key in self._moves)
+        finished = []
+        for controller in controllers:
+            # hold the board while positions are computed and written, so a
+            # set_position from another thread lands before or after this tick
+            with controller.pwm_device.batch():
+                updates = {}
+                with self._lock:
+                    for key, move in list(self._moves.items()):
+                        if key[0] is not controller:
+                            continue
+                        channel = key[1]
+                        elapsed = max(0.0, now - move.start_time)
+                        if elapsed >= move.duration:
+                            position = move.target
+                            del self._moves[key]
+                            finished.append(move.done)
+                        else:
+                            progress = move.profile(elapsed / move.duration)
+                            position = move.start + (move.target - move.start) * progress
+                        controller._positions[channel] = position
+                        updates[channel] = (0, controller._get_pulse(channel, position))
+                controller.pwm_device.set_pwm_many(updates)
+        with self._lock:
+            for done in finished:
+                self._check_done(done)
+            if not self._moves:
+                self._thread.stop_ticking()
+
+_motion_engine = None
+
+def get_motion_engine():
+    """Return the motion engine shared by all PCA9685 servo controllers."""
+    global _motion_engine
+    if _motion_engine is None:
+        _motion_engine = ServoMotionEngine()
+    return _motion_engine
 
 class _ServoController(ServoMotorControllerBase):
-    def __init__(self, controller_id, pwm_device):
+    def __init__(self, controller_id, pwm_device, calibration_file=None):
         ServoMotorControllerBase.__init__(self, controller_id, "PCA9685", 16)
         self.pwm_device = pwm_device
+        self.calibration_file = calibration_file
 
-        self._pulse_length = 1000000    # 1,000,000 us per second
-        self._pulse_length //= 60       # 60 Hz
-        #print('{0}us per period'.format(self._pulse_length))
-        self._pulse_length //= 4096     # 12 bits of resolution
-        #print('{0}us per bit'.format(self._pulse_length))
+        # Per channel calibration in microseconds.
+        self._calibration = [
+            {"min": DEFAULT_MIN_PULSE, "center": DEFAULT_CENTER_PULSE, "max": DEFAULT_MAX_PULSE, "inverted": False}
+            for channel in range(16)
+        ]
+        # Last position set on each channel and the adjustments used for it.
+        self._positions = [None] * 16
+        self._adjustments = [(0, 0, 0)] * 16
+        # Position to pwm count lookup per channel, index is position + 100.
+        self._pulse_tables = [None] * 16
+        self._table_frequency = None
 
-    def _set_position(self, channel, position, adjust_min=0, adjust_max=0, adjust_center=0):
-        print("sp", channel, position)
-        pulse_min = 200 + 200 * adjust_min
-        pulse_center = 400 + 400 * adjust_center
-        pulse_max = 600 + 600 * adjust_max
+        if calibration_file and os.path.exists(calibration_file):
+            self.load_calibration(calibration_file)
+
+    def calibrate(self, channel, min_pulse=None, center_pulse=None, max_pulse=None, inverted=None):
+        """
+        Set the calibration of a servo channel.
+
+        :param min_pulse: Pulse width in microseconds at position -100.
+        :param center_pulse: Pulse width in microseconds at position 0.
+        :param max_pulse: Pulse width in microseconds at position 100.
+        :param inverted: Swap the direction of the servo.
+        """
+        self._validate_motor(channel)
+        calibration = self._calibration[channel]
+        if min_pulse is not None:
+            calibration["min"] = min_pulse
+        if center_pulse is not None:
+            calibration["center"] = center_pulse
+        if max_pulse is not None:
+            calibration["max"] = max_pulse
+        if inverted is not None:
+            calibration["inverted"] = bool(inverted)
+        self._pulse_tables[channel] = None
 
-        if position == 0:
-            pulse = pulse_center
-        elif position > 0:
-            pulse = pulse_center + (pulse_max - pulse_center) * (position/100.0)
-        else:
-            pulse = pulse_center + (pulse_center - pulse_min) * (position/100.0)
+    def get_calibration(self, channel):
+        """Return the calibration of a channel as a dict with min, center, max and inverted."""
+        return dict(self._calibration[channel])
 
-        #servo_pulse = 1000 * pulse
-        #servo_pulse //= self._pulse_length
+    def load_calibration(self, file_name=None):
+        """Load calibration for all channels from a json file written by save_calibration."""
+        with open(file_name or self.calibration_file) as calibration_file:
+            calibration = json.load(calibration_file)
+        for channel, values in iter(calibration.items()):
+            self.calibrate(
+                int(channel),
+                values.get("min"),
+                values.get("center"),
+                values.get("max"),
+                values.get("inverted")
+            )
 
-        #print("sp", channel, position, int(pulse), int(servo_pulse))
-        self.pwm_device.set_pwm(channel, 0, int(pulse))
+    def save_calibration(self, file_name=None):
+        """Save the calibration of all channels to a json file."""
+        calibration = dict((str(channel), values) for channel, values in enumerate(self._calibration))
+        with open(file_name or self.calibration_file, "w") as calibration_file:
+            json.dump(calibration, calibration_file, indent=4, sort_keys=True)
+
+    def move(self, targets, duration=None, max_speed=100, profile=TRAPEZOID):
+        """
+        Move servos smoothly to new positions, all servos arrive at the same time.
+
+        :param targets: Dict of channel to position (-100 to 100).
+        :type targets: ``dict``
+
+        :return: ``threading.Event`` that is set when the move is done.
+        """
+        for channel in targets:
+            self._validate_motor(channel)
+        return get_motion_engine().move(
+            dict(((self, channel), position) for channel, position in targets.items()),
+            duration,
+            max_speed,
+            profile
+        )
+
+    def stop_motion(self, channel=None):
+        """Stop moving servos at their current position."""
+        get_motion_engine().cancel(self, channel)
+
+    def _build_pulse_table(self, channel):
+        calibration = self._calibration[channel]
+        adjust_min, adjust_max, adjust_center = self._adjustments[channel]
+        pulse_min = calibration["min"] * (1 + adjust_min)
+        pulse_center = calibration["center"] * (1 + adjust_center)
+        pulse_max = calibration["max"] * (1 + adjust_max)
+        counts_per_us = self._table_frequency * 4096 / 1000000.0
+
+        table = []
+        for position in range(-100, 101):
+            if calibration["inverted"]:
+                position = -position
+            if position >= 0:
+                pulse = pulse_center + (pulse_max - pulse_center) * (position/100.0)
+            else:
+                pulse = pulse_center + (pulse_center - pulse_min) * (position/100.0)
+            table.append(int(round(pulse * counts_per_us)))
+        self._pulse_tables[channel] = table
+        return table
+
+    def _get_pulse(self, channel, position):
+        frequency = self.pwm_device.frequency or DEFAULT_FREQUENCY
+        if frequency != self._table_frequency:
+            self._table_frequency = frequency
+            self._pulse_tables = [None] * 16
+        table = self._pulse_tables[channel] or self._build_pulse_table(channel)
+
+        index = max(-100, min(100, position)) + 100
+        if isinstance(index, int):
+            return table[index]
+        lower = int(math.floor(index))
+        if lower == 200:
+            return table[200]
+        return int(round(table[lower] + (table[lower + 1] - table[lower]) * (index - lower)))
+
+    def _set_position(self, channel, position, adjust_min=0, adjust_max=0, adjust_center=0):
+        if _motion_engine:
+            _motion_engine.cancel(self, channel)
+        adjustments = (adjust_min, adjust_max, adjust_center)
+        if adjustments != self._adjustments[channel]:
+            self._adjustments[channel] = adjustments
+            self._pulse_tables[channel] = None
+        self._positions[channel] = position
+        self.pwm_device.set_pwm(channel, 0, self._get_pulse(channel, position))
 
 class PCA9685ServoDeviceDriver(MotorControllerBoard):
-    def __init__(self, address=0x60, bus=None, board_id="PCA9685", board_name="PCA9685"):
-        self.pwm = PCA9685DeviceDriver(address, bus)
-        self.pwm.set_pwm_freq(60)
+    def __init__(self, address=0x60, bus=None, board_id="PCA9685", board_name="PCA9685", calibration_file=None):
+        self.pwm = PCA9685DeviceDriver(address, bus, frequency=60)
 
         MotorControllerBoard.__init__(
             self,
             board_id,
             board_name,
-            servo_controller=_ServoController(board_id+".servo_motors", self.pwm),
+            servo_controller=_ServoController(board_id+".servo_motors", self.pwm, calibration_file),
         )
-
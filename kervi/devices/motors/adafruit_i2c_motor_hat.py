@@ -1,7 +1,11 @@
 
 import time
+import math
+import threading
 
 from kervi.devices.pwm.PCA9685 import PCA9685DeviceDriver
+from kervi.devices.polling import DeviceTickThread
+from kervi.devices.motors.ramp import RampedDCMotors
 from kervi.hal.motor_controller import MotorControllerBoard, DCMotor, DCMotorControllerBase, StepperMotor, StepperMotorControllerBase
 
 FORWARD = 1
@@ -14,7 +18,31 @@ DOUBLE = 2
 INTERLEAVE = 3
 MICROSTEP = 4
 
-class _DCMotorController(DCMotorControllerBase):
+def _start_rate(target_rate, accel):
+    """Rate of the first step of a ramp."""
+    if accel:
+        return min(target_rate, math.sqrt(2 * accel))
+    return target_rate
+
+def _next_rate(rate, target_rate, accel, remaining):
+    """
+    Rate of the next step of a trapezoidal ramp, rates are in steps per second
+    and accel in steps per second squared. Deceleration starts when the
+    remaining steps, None when running without end, reach the stopping distance.
+    """
+    if not accel:
+        return target_rate
+    # rate change over one step with constant acceleration: v1^2 = v0^2 +- 2a
+    delta = 2 * accel
+    if remaining is not None and remaining <= rate * rate / delta:
+        return max(math.sqrt(max(rate * rate - delta, 0)), _start_rate(target_rate, accel))
+    if rate < target_rate:
+        return min(target_rate, math.sqrt(rate * rate + delta))
+    if rate > target_rate:
+        return max(target_rate, math.sqrt(max(rate * rate - delta, 0)))
+    return rate
+
+class _DCMotorController(RampedDCMotors, DCMotorControllerBase):
     def __init__(self, controller_id, pwm):
         self.pwm_device = pwm
         DCMotorControllerBase.__init__(self, controller_id, "Adafruit DC + Stepper hat:dc", 4)
@@ -44,30 +72,59 @@ class _DCMotorController(DCMotorControllerBase):
         in1_pin = in1
         in2_pin = in2
 
-        if speed > 0:
-            self.pwm_device.set(in2_pin, 0)
-            self.pwm_device.set(in1_pin, 1)
-        if speed < 0:
-            self.pwm_device.set(in1_pin, 0)
-            self.pwm_device.set(in2_pin, 1)
-        if speed == 0:
-            self.pwm_device.set(in1_pin, 0)
-            self.pwm_device.set(in2_pin, 0)
+        with self.pwm_device.batch():
+            if speed > 0:
+                self.pwm_device.set(in2_pin, 0)
+                self.pwm_device.set(in1_pin, 1)
+            if speed < 0:
+                self.pwm_device.set(in1_pin, 0)
+                self.pwm_device.set(in2_pin, 1)
+            if speed == 0:
+                self.pwm_device.set(in1_pin, 0)
+                self.pwm_device.set(in2_pin, 0)
 
-        self.pwm_device.set_pwm(pwm_pin, 0, abs(int(4095 * (speed/100))))
+            self.pwm_device.set_pwm(pwm_pin, 0, abs(int(4095 * (speed/100))))
+
+    def _apply_speeds(self, speeds):
+        with self.pwm_device.batch():
+            for motor, speed in iter(speeds.items()):
+                self._set_speed(motor, speed)
 
 class _StepperMotor(StepperMotor):
 
     MICROSTEP_CURVE = [0, 50, 98, 142, 180, 212, 236, 250, 255]
 
-    #MICROSTEPS = 16
+    # microstep curves by number of microsteps,
     # a sinusoidal curve NOT LINEAR!
-    #MICROSTEP_CURVE = [0, 25, 50, 74, 98, 120, 141, 162, 180, 197, 212, 225, 236, 244, 250, 253, 255]
+    MICROSTEP_CURVES = {
+        8: MICROSTEP_CURVE,
+        16: [0, 25, 50, 74, 98, 120, 141, 162, 180, 197, 212, 225, 236, 244, 250, 253, 255]
+    }
+
+    # coils energized for each half step, in the order AIN2, BIN1, AIN1, BIN2
+    STEP_COILS = [
+        [1, 0, 0, 0],
+        [1, 1, 0, 0],
+        [0, 1, 0, 0],
+        [0, 1, 1, 0],
+        [0, 0, 1, 0],
+        [0, 0, 1, 1],
+        [0, 0, 0, 1],
+        [1, 0, 0, 1]
+    ]
 
-    def __init__(self, pwm_device, num, steps=200):
+    def __init__(self, pwm_device, num, steps=200, microsteps=8):
         StepperMotor.__init__(self, pwm_device, num)
         self.pwm = pwm_device
         self.revsteps = steps
+        if microsteps not in self.MICROSTEP_CURVES:
+            raise ValueError('MotorHAT Stepper microsteps must be 8 or 16')
+        self.MICROSTEPS = microsteps
+        # step tables by step style, built when the style is first used
+        self._step_tables = {}
+        # absolute position in microsteps and the channel values last written
+        self._position = 0
+        self._written = None
         if num == 0:
             self.PWMA = 8
             self.AIN2 = 9
@@ -85,128 +142,366 @@ class _StepperMotor(StepperMotor):
         else:
             raise NameError('MotorHAT Stepper must be between 1 and 2 inclusive')
 
+        # State of the background stepping, rates are in steps per second
+        # where a step is one call to _step in the current style.
+        self._lock = threading.Lock()
+        self._runner = None
+        self._moving = False
+        self._next = None
+        self._done = None
+        self._direction = FORWARD
+        self._style = SINGLE
+        self._remaining = None
+        self._rate = 0
+        self._target_rate = 0
+        self._accel = None
+
+    def _steps_per_full_step(self, style):
+        if style == INTERLEAVE:
+            return 2
+        if style == MICROSTEP:
+            return self.MICROSTEPS
+        return 1
+
+    def move(self, steps, rpm=60, accel=None, style=None):
+        """
+        Move a number of full steps in the background.
+
+        :param steps: Full steps to move, negative steps move backward.
+        :type steps: ``int``
+
+        :param rpm: Cruise speed in revolutions per minute.
+        :type rpm: ``float``
+
+        :param accel: Acceleration and deceleration in rpm per second, None
+            starts and stops at full speed.
+        :type accel: ``float``
+
+        :param style: SINGLE, DOUBLE, INTERLEAVE or MICROSTEP, defaults to step_style.
+
+        :return: ``threading.Event`` that is set when the move is done or stopped.
+        """
+        direction = FORWARD if steps >= 0 else BACKWARD
+        style = style or self.step_style
+        return self._start(direction, int(round(abs(steps) * self._steps_per_full_step(style))), rpm, accel, style)
+
+    def run(self, rpm, accel=None, style=None):
+        """
+        Run continuously until stop is called, negative rpm runs backward.
+        Calling run while running changes the speed along the acceleration ramp.
+
+        :return: ``threading.Event`` that is set when the motor has stopped.
+        """
+        direction = FORWARD if rpm >= 0 else BACKWARD
+        return self._start(direction, None, abs(rpm), accel, style or self.step_style)
+
+    def stop(self, brake=False):
+        """
+        Stop background stepping. The motor decelerates with the acceleration
+        of the current move unless brake is True or the move has no ramp.
+        When braking the coils stay energized and hold the position.
+        """
+        with self._lock:
+            self._stop_moving(brake)
+
+    def _stop_moving(self, brake=False):
+        self._next = None
+        if not self._moving or brake or not self._accel:
+            self._finish()
+        else:
+            self._remaining = self._stopping_distance()
+            if not self._remaining:
+                self._finish()
+
+    def _stopping_distance(self):
+        return int(self._rate * self._rate / (2 * self._accel))
+
+    def release(self):
+        """Stop stepping and de-energize the coils."""
+        self.stop(brake=True)
+        self._release()
+
+    @property
+    def is_moving(self):
+        """True while background stepping is active."""
+        return self._moving
+
+    def _start(self, direction, remaining, rpm, accel, style):
+        done = threading.Event()
+        scale = self.revsteps * self._steps_per_full_step(style) / 60.0
+        move = (direction, remaining, rpm * scale, accel * scale if accel else None, style)
+        with self._lock:
+            if self._done:
+                self._done.set()
+            self._done = done
+            if remaining == 0 or not rpm:
+                self._stop_moving()
+                return done
+            self._next = None
+            if self._moving and (direction != self._direction or style != self._style):
+                # slow down to a stop on the current ramp before reversing or
+                # changing step style
+                if self._accel and self._stopping_distance():
+                    self._remaining = self._stopping_distance()
+                    self._next = move
+                    return done
+                self._rate = 0
+            self._begin(move)
+        return done
+
+    def _begin(self, move):
+        self._direction, self._remaining, self._target_rate, self._accel, self._style = move
+        if not self._moving:
+            self._rate = 0
+        if not self._rate:
+            self._rate = self._start_rate()
+        if not self._moving:
+            self._moving = True
+            if self._runner is None:
+                self._runner = DeviceTickThread(self._run_step, 1.0 / self._rate)
+            self._runner.interval = 1.0 / self._rate
+            self._runner.start_ticking()
+
+    def _start_rate(self):
+        return _start_rate(self._target_rate, self._accel)
+
+    def _next_rate(self):
+        return _next_rate(self._rate, self._target_rate, self._accel, self._remaining)
+
+    def _finish(self):
+        if self._moving:
+            self._moving = False
+            self._runner.stop_ticking()
+        self._rate = 0
+        if self._done:
+            self._done.set()
+            self._done = None
+
+    def _run_step(self):
+        with self._lock:
+            if not self._moving:
+                return
+            self._step(self._direction, self._style)
+            if self._remaining is not None:
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    if self._next is None:
+                        self._finish()
+                        return
+                    # stopped for a reversal or style change, start the next move
+                    move = self._next
+                    self._next = None
+                    self._rate = 0
+                    self._begin(move)
+                    self._runner.interval = 1.0 / self._rate
+                    return
+            self._rate = self._next_rate()
+            self._runner.interval = 1.0 / self._rate
+
     def _release(self):
-        self.pwm.set(self.PWMA, 0)
-        self.pwm.set(self.AIN2, 0)
-        self.pwm.set(self.BIN1, 0)
-        self.pwm.set(self.AIN1, 0)
-        self.pwm.set(self.BIN2, 0)
-        self.pwm.set(self.PWMB, 0)
+        self._written = None
+        with self.pwm.batch():
+            self.pwm.set(self.PWMA, 0)
+            self.pwm.set(self.AIN2, 0)
+            self.pwm.set(self.BIN1, 0)
+            self.pwm.set(self.AIN1, 0)
+            self.pwm.set(self.BIN2, 0)
+            self.pwm.set(self.PWMB, 0)
 
     def _step(self, dir, style):
-        pwm_a = pwm_b = 255
-
-        # first determine what sort of stepping procedure we're up to
-        if style == self.SINGLE:
-            if (self.current_step//(self.MICROSTEPS//2)) % 2:
-                # we're at an odd step, weird
-                if dir == FORWARD:
-                    self.current_step += self.MICROSTEPS//2
-                else:
-                    self.current_step -= self.MICROSTEPS//2
-            else:
-                # go to next even step
-                if dir == FORWARD:
-                    self.current_step += self.MICROSTEPS
-                else:
-                    self.current_step -= self.MICROSTEPS
-        if style == self.DOUBLE:
-            if not self.current_step//(self.MICROSTEPS//2) % 2:
-                # we're at an even step, weird
-                if dir == FORWARD:
-                    self.current_step += self.MICROSTEPS//2
-                else:
-                    self.current_step -= self.MICROSTEPS//2
-            else:
-                # go to next odd step
-                if dir == self.FORWARD:
-                    self.current_step += self.MICROSTEPS
-                else:
-                    self.current_step -= self.MICROSTEPS
-        if style == self.INTERLEAVE:
-            if dir == FORWARD:
-                self.current_step += self.MICROSTEPS//2
+        tables = self._step_tables.get(style) or self._build_step_tables(style)
+        next_step, values = tables
+        current_step = self.current_step % len(values)
+        self.current_step = next_step[dir == FORWARD][current_step]
+        delta = self.current_step - current_step
+        if dir == FORWARD:
+            self._position += delta % len(values)
+        else:
+            self._position -= -delta % len(values)
+        channels = values[self.current_step]
+        if channels is not self._written:
+            self.pwm.set_pwm_many(channels)
+            self._written = channels
+        return self.current_step
+
+    @property
+    def position(self):
+        """Absolute position in full steps, counted from where the motor was created or zeroed."""
+        return self._position / float(self.MICROSTEPS)
+
+    def zero(self):
+        """Make the current position position 0."""
+        self._position = 0
+
+    @property
+    def coils(self):
+        """Energized coils in the order AIN2, BIN1, AIN1, BIN2, None before the first step."""
+        if self._written is None:
+            return None
+        return [self._written[pin] == (4096, 0) for pin in [self.AIN2, self.BIN1, self.AIN1, self.BIN2]]
+
+    def move_to(self, position, rpm=60, accel=None, style=None):
+        """
+        Move in the background to an absolute position in full steps,
+        see move for the other parameters.
+        """
+        return self.move(position - self.position, rpm, accel, style)
+
+    def _build_step_tables(self, style):
+        """
+        Build the tables for a step style. The first maps direction and
+        current_step to the next step, the second maps a step to the
+        (on, off) values of all six channels of the motor.
+        """
+        microsteps = self.MICROSTEPS
+        half = microsteps // 2
+        cycle = microsteps * 4
+
+        next_step = ([], [])
+        for current_step in range(cycle):
+            if style == SINGLE:
+                delta = half if (current_step // half) % 2 else microsteps
+            elif style == DOUBLE:
+                delta = microsteps if (current_step // half) % 2 else half
+            elif style == INTERLEAVE:
+                delta = half
             else:
-                self.current_step -= self.MICROSTEPS//2
+                delta = 1
+            next_step[0].append((current_step - delta) % cycle)
+            next_step[1].append((current_step + delta) % cycle)
 
-        if style == MICROSTEP:
-            if dir == FORWARD:
-                self.current_step += 1
+        curve = self.MICROSTEP_CURVES[microsteps]
+        values = []
+        for current_step in range(cycle):
+            quarter, offset = divmod(current_step, microsteps)
+            if style == MICROSTEP:
+                if quarter % 2:
+                    pwm_a, pwm_b = curve[offset], curve[microsteps - offset]
+                else:
+                    pwm_a, pwm_b = curve[microsteps - offset], curve[offset]
+                coils = [[1, 1, 0, 0], [0, 1, 1, 0], [0, 0, 1, 1], [1, 0, 0, 1]][quarter]
             else:
-                self.current_step -= 1
-
-                # go to next 'step' and wrap around
-                self.current_step += self.MICROSTEPS * 4
-                self.current_step %= self.MICROSTEPS * 4
-
-            pwm_a = pwm_b = 0
-            if (self.current_step >= 0) and (self.current_step < self.MICROSTEPS):
-                pwm_a = self.MICROSTEP_CURVE[self.MICROSTEPS - self.current_step]
-                pwm_b = self.MICROSTEP_CURVE[self.current_step]
-            elif (self.current_step >= self.MICROSTEPS) and (self.current_step < self.MICROSTEPS*2):
-                pwm_a = self.MICROSTEP_CURVE[self.current_step - self.MICROSTEPS]
-                pwm_b = self.MICROSTEP_CURVE[self.MICROSTEPS*2 - self.current_step]
-            elif (self.current_step >= self.MICROSTEPS*2) and (self.current_step < self.MICROSTEPS*3):
-                pwm_a = self.MICROSTEP_CURVE[self.MICROSTEPS*3 - self.current_step]
-                pwm_b = self.MICROSTEP_CURVE[self.current_step - self.MICROSTEPS*2]
-            elif (self.current_step >= self.MICROSTEPS*3) and (self.current_step < self.MICROSTEPS*4):
-                pwm_a = self.MICROSTEP_CURVE[self.current_step - self.MICROSTEPS*3]
-                pwm_b = self.MICROSTEP_CURVE[self.MICROSTEPS*4 - self.current_step]
-
-
-        # go to next 'step' and wrap around
-        self.current_step += self.MICROSTEPS * 4
-        self.current_step %= self.MICROSTEPS * 4
-
-        # only really used for microstepping, otherwise always on!
-        self.pwm.set_pwm(self.PWMA, 0, pwm_a*16)
-        self.pwm.set_pwm(self.PWMB, 0, pwm_b*16)
-
-        # set up coil energizing!
-        coils = [0, 0, 0, 0]
+                pwm_a = pwm_b = 255
+                coils = self.STEP_COILS[current_step // half]
+            pins = [self.AIN2, self.BIN1, self.AIN1, self.BIN2]
+            channels = {self.PWMA: (0, pwm_a * 16), self.PWMB: (0, pwm_b * 16)}
+            for pin, coil in zip(pins, coils):
+                channels[pin] = (4096, 0) if coil else (0, 4096)
+            values.append(channels)
 
-        if style == MICROSTEP:
-            if (self.current_step >= 0) and (self.current_step < self.MICROSTEPS):
-                coils = [1, 1, 0, 0]
-            elif (self.current_step >= self.MICROSTEPS) and (self.current_step < self.MICROSTEPS*2):
-                coils = [0, 1, 1, 0]
-            elif (self.current_step >= self.MICROSTEPS*2) and (self.current_step < self.MICROSTEPS*3):
-                coils = [0, 0, 1, 1]
-            elif (self.current_step >= self.MICROSTEPS*3) and (self.current_step < self.MICROSTEPS*4):
-                coils = [1, 0, 0, 1]
-        else:
-            step2coils = [
-                [1, 0, 0, 0],
-                [1, 1, 0, 0],
-                [0, 1, 0, 0],
-                [0, 1, 1, 0],
-                [0, 0, 1, 0],
-                [0, 0, 1, 1],
-                [0, 0, 0, 1],
-                [1, 0, 0, 1]
-            ]
-            coils = step2coils[self.current_step//(self.MICROSTEPS//2)]
-
-        #print "coils state = " + str(coils)
-        self.pwm.set(self.AIN2, coils[0])
-        self.pwm.set(self.BIN1, coils[1])
-        self.pwm.set(self.AIN1, coils[2])
-        self.pwm.set(self.BIN2, coils[3])
+        self._step_tables[style] = (next_step, values)
+        return self._step_tables[style]
 
-        return self.current_step
+class _LinearMove(object):
+    """
+    Straight line move of both steppers. The axis with most steps steps on
+    every tick and the other axis follows with Bresenham error accumulation.
+    """
+    def __init__(self, motors, ticks, directions, style, rate, accel, done):
+        self.motors = motors
+        self.ticks = ticks
+        self.directions = directions
+        self.style = style
+        self.major = max(ticks)
+        self.errors = [0, 0]
+        self.remaining = self.major
+        self.target_rate = rate
+        self.accel = accel
+        self.rate = _start_rate(rate, accel)
+        self.done = done
 
 class _StepperMotorController(StepperMotorControllerBase):
     def __init__(self, controller_id, pwm):
         self.pwm = pwm
         StepperMotorControllerBase.__init__(self, controller_id, "Adafruit DC + Stepper hat:servo", 2)
+        self._motors = [_StepperMotor(pwm, 0), _StepperMotor(pwm, 1)]
+        self._lock = threading.Lock()
+        self._linear = None
+        self._runner = None
+
+    def move_linear(self, dx, dy, feed_rate=100, accel=None, style=None):
+        """
+        Move both steppers along a straight line, motor 0 is x and motor 1 is y.
+        Both motors step on one shared timeline and their channel updates of a
+        tick are written together.
+
+        :param dx: Full steps to move motor 0, negative moves backward.
+        :param dy: Full steps to move motor 1, negative moves backward.
+
+        :param feed_rate: Speed along the line in full steps per second.
+        :type feed_rate: ``float``
+
+        :param accel: Acceleration along the line in full steps per second squared,
+            None starts and stops at full speed.
+        :type accel: ``float``
+
+        :param style: SINGLE, DOUBLE, INTERLEAVE or MICROSTEP, defaults to step_style of motor 0.
+
+        :return: ``threading.Event`` that is set when the move is done or stopped.
+        """
+        for motor in self._motors:
+            motor.stop(brake=True)
+        style = style or self._motors[0].step_style
+        factor = self._motors[0]._steps_per_full_step(style)
+        ticks = [int(round(abs(dx) * factor)), int(round(abs(dy) * factor))]
+        directions = [FORWARD if dx >= 0 else BACKWARD, FORWARD if dy >= 0 else BACKWARD]
+        done = threading.Event()
+        with self._lock:
+            self._stop_linear()
+            if not max(ticks) or not feed_rate:
+                done.set()
+                return done
+            # rates of the major axis in ticks per second
+            scale = factor * max(ticks) / math.hypot(ticks[0], ticks[1])
+            move = _LinearMove(
+                self._motors, ticks, directions, style,
+                feed_rate * scale, accel * scale if accel else None, done
+            )
+            if self._runner is None:
+                self._runner = DeviceTickThread(self._linear_step, 1.0 / move.rate)
+            self._runner.interval = 1.0 / move.rate
+            self._linear = move
+            self._runner.start_ticking()
+        return done
+
+    def stop_linear(self):
+        """Stop a linear move at once, the coils stay energized."""
+        with self._lock:
+            self._stop_linear()
+
+    def _stop_linear(self):
+        move = self._linear
+        if move:
+            self._runner.stop_ticking()
+            move.done.set()
+            self._linear = None
+
+    def _linear_step(self):
+        with self._lock:
+            move = self._linear
+            if move is None:
+                return
+            with self.pwm.batch():
+                for axis in (0, 1):
+                    move.errors[axis] += move.ticks[axis]
+                    if 2 * move.errors[axis] >= move.major:
+                        move.errors[axis] -= move.major
+                        move.motors[axis]._step(move.directions[axis], move.style)
+            move.remaining -= 1
+            if move.remaining <= 0:
+                self._stop_linear()
+                return
+            move.rate = _next_rate(move.rate, move.target_rate, move.accel, move.remaining)
+            self._runner.interval = 1.0 / move.rate
 
     def __getitem__(self, motor):
-        return _StepperMotor(self.pwm, motor)
+        if motor not in (0, 1):
+            raise NameError('MotorHAT Stepper must be between 1 and 2 inclusive')
+        return self._motors[motor]
 
 class AdafruitMotorHAT(MotorControllerBoard):
     def __init__(self, address=0x60, bus=None, board_id="adafruit_motor_hat"):
-        self.pwm = PCA9685DeviceDriver(address, bus)
-        self.pwm.set_pwm_freq(60)
+        self.pwm = PCA9685DeviceDriver(address, bus, frequency=60)
 
         MotorControllerBoard.__init__(
             self,
@@ -215,3 +510,8 @@ class AdafruitMotorHAT(MotorControllerBoard):
             dc_controller=_DCMotorController(board_id + ".dc_motors",self.pwm),
             stepper_controller=_StepperMotorController(board_id + ".stepper_motors",self.pwm)
         )
+
+    def move_linear(self, dx, dy, feed_rate=100, accel=None, style=None):
+        """Coordinated straight line move of stepper 0 (x) and stepper 1 (y),
+        see _StepperMotorController.move_linear."""
+        return self.stepper_motors.move_linear(dx, dy, feed_rate, accel, style)
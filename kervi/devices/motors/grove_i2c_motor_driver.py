@@ -1,7 +1,9 @@
 
 
+import threading
 from kervi.hal import get_i2c
 from kervi.hal.motor_controller import MotorControllerBoard, DCMotorControllerBase, StepperMotorControllerBase
+from kervi.devices.motors.ramp import RampedDCMotors, get_ramp_engine
 
 MOTOR_SPEED_SET = 0x82
 PWM_FREQUENCE_SET = 0x84
@@ -19,7 +21,7 @@ BOTH_ANTI_CLOCK_WISE = 0x05
 M1_CW_M2_ACW = 0x06
 M1_ACW_M2CW = 0x09
 
-class _DCMotorDeviceDriver(DCMotorControllerBase):
+class _DCMotorDeviceDriver(RampedDCMotors, DCMotorControllerBase):
     def __init__(self, controller_id, address=I2C_MOTOR_DRIVER_ADD, bus=None):
         DCMotorControllerBase.__init__(self, controller_id, "Grove i2c motor driver", 2)
         self.i2c = get_i2c(address, bus)
@@ -29,10 +31,39 @@ class _DCMotorDeviceDriver(DCMotorControllerBase):
         self.m1_direction = 1
         self.m2_direction = 1
 
+        # last values written, writes of unchanged values are skipped
+        self._written_speeds = None
+        self._written_direction = None
+        self._lock = threading.Lock()
+
+    def set_speeds(self, m1, m2):
+        """
+        Set the speed of both motors at once, stops ramps running on them.
+        Only the registers that change are written.
+
+        :param m1: Speed of motor 1 from -100 to +100.
+        :param m2: Speed of motor 2 from -100 to +100.
+        """
+        self.cancel_ramps()
+        self._write_speeds({1: m1, 0: m2})
+
+    def cancel_ramps(self):
+        """Stop ramps of both motors at their current speed."""
+        get_ramp_engine().cancel(self)
+
     def _map(self, x, in_min, in_max, out_min, out_max):
         return abs(int((x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min))
 
     def _set_speed(self, motor, speed):
+        self._apply_speeds({motor: speed})
+
+    def _apply_speeds(self, speeds):
+        with self._lock:
+            for motor, speed in iter(speeds.items()):
+                self._update_motor(motor, speed)
+            self._write_motors()
+
+    def _update_motor(self, motor, speed):
         if motor == 1:
             self.m1_speed = self._map(speed, 0, 100, 0, 255)
             if speed >= 0:
@@ -47,6 +78,7 @@ class _DCMotorDeviceDriver(DCMotorControllerBase):
             else:
                 self.m2_direction = -1
 
+    def _write_motors(self):
         if self.m1_direction == 1 and self.m2_direction == 1:
             direction = BOTH_CLOCK_WISE
         if self.m1_direction == 1 and self.m2_direction == -1:
@@ -56,8 +88,13 @@ class _DCMotorDeviceDriver(DCMotorControllerBase):
         if self.m1_direction == -1 and self.m2_direction == -1:
             direction = BOTH_ANTI_CLOCK_WISE
 
-        self.i2c.write_list(MOTOR_SPEED_SET, [self.m1_speed, self.m2_speed])
-        self.i2c.write_list(DIRECTION_SET, [direction, NOTHING])
+        speeds = [self.m1_speed, self.m2_speed]
+        if speeds != self._written_speeds:
+            self.i2c.write_list(MOTOR_SPEED_SET, speeds)
+            self._written_speeds = speeds
+        if direction != self._written_direction:
+            self.i2c.write_list(DIRECTION_SET, [direction, NOTHING])
+            self._written_direction = direction
 
 class _StepperMotorDeviceDriver(StepperMotorControllerBase):
     def __init__(self, controller_id, address, bus=None):
@@ -65,7 +102,7 @@ class _StepperMotorDeviceDriver(StepperMotorControllerBase):
         self.i2c = get_i2c(address, bus)
 
     def step(self, num_step):
-        self.i2c.write_i2c_block_data(I2C_MOTOR_DRIVER_ADD, STEPERNU, [num_step, NOTHING])
+        self.i2c.write_list(STEPERNU, [num_step, NOTHING])
 
         ## Enanble the i2c motor driver to drive a 4-wire stepper. the i2c motor driver will
         ## driver a 4-wire with 8 polarity  .
@@ -81,11 +118,11 @@ class _StepperMotorDeviceDriver(StepperMotorControllerBase):
             direction = 0
 
         speed = abs(int(step_interval / 4))
-        self.i2c.write_i2c_block_data(I2C_MOTOR_DRIVER_ADD, ENABLE_STEPPER, [direction, speed])
+        self.i2c.write_list(ENABLE_STEPPER, [direction, speed])
 
     ##function to uneanble i2C motor drive to drive the stepper.
     def stop(self):
-        self.i2c.write_i2c_block_data(I2C_MOTOR_DRIVER_ADD, UNENABLE_STEPPER, [NOTHING, NOTHING])
+        self.i2c.write_list(UNENABLE_STEPPER, [NOTHING, NOTHING])
 
 
 class GroveMotorController(MotorControllerBoard):
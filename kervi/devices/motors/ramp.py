@@ -0,0 +1,162 @@
+# Copyright (c) 2017, Tim Wentzlau
+# Licensed under MIT
+
+"""
+Soft start and stop of DC motors.
+
+.. code:: python
+
+    board = AdafruitMotorHAT()
+    board.dc_motors.set_ramp(accel=50, decel=100)
+    board.dc_motors.ramp_to(0, 80)
+"""
+
+import threading
+from kervi.devices.polling import DeviceTickThread, clock
+
+def _ramp(current, target, accel, decel, elapsed):
+    """Return the speed after elapsed seconds of ramping from current toward target."""
+    if current * target < 0:
+        # reverse, slow down to 0 first
+        rate, limit = decel, 0
+    elif abs(target) < abs(current):
+        rate, limit = decel, target
+    else:
+        rate, limit = accel, target
+    if not rate:
+        return limit
+    change = rate * elapsed
+    if current < limit:
+        return min(limit, current + change)
+    return max(limit, current - change)
+
+class _Ramp(object):
+    def __init__(self, current, target, done):
+        self.current = current
+        self.target = target
+        self.done = done
+
+class DCRampEngine(object):
+    """
+    Ramps DC motor speeds from one fixed rate thread.
+
+    Each tick the new speeds of a controller are handed to its _apply_speeds
+    together, so drivers can write all motors of a board in one batch.
+    The thread only runs while motors are ramping.
+    """
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self._ramps = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_tick = None
+
+    def ramp_to(self, controller, motor, speed):
+        """Ramp a motor of controller to speed, returns a ``threading.Event`` that is set when it is reached."""
+        done = threading.Event()
+        with self._lock:
+            ramp = self._ramps.pop((controller, motor), None)
+            if ramp:
+                ramp.done.set()
+            current = controller._speeds.get(motor, 0)
+            if current == speed:
+                done.set()
+                return done
+            self._ramps[(controller, motor)] = _Ramp(current, speed, done)
+            if self._thread is None:
+                self._thread = DeviceTickThread(self._tick, self.interval)
+            if not self._thread.alive:
+                self._last_tick = clock()
+                self._thread.start_ticking()
+        return done
+
+    def cancel(self, controller, motor=None):
+        """Stop ramping motors of controller, they keep their current speed."""
+        with self._lock:
+            for key in list(self._ramps):
+                if key[0] is controller and (motor is None or key[1] == motor):
+                    self._ramps.pop(key).done.set()
+
+    def _tick(self):
+        now = clock()
+        updates = {}
+        finished = []
+        with self._lock:
+            elapsed = now - self._last_tick
+            self._last_tick = now
+            for key, ramp in list(self._ramps.items()):
+                controller, motor = key
+                ramp.current = _ramp(ramp.current, ramp.target, controller.accel, controller.decel, elapsed)
+                if ramp.current == ramp.target:
+                    del self._ramps[key]
+                    finished.append(ramp.done)
+                updates.setdefault(controller, {})[motor] = ramp.current
+            if not self._ramps:
+                self._thread.stop_ticking()
+        for controller, speeds in iter(updates.items()):
+            controller._write_speeds(speeds)
+        for done in finished:
+            done.set()
+
+_ramp_engine = None
+
+def get_ramp_engine():
+    """Return the ramp engine shared by all DC motor controllers."""
+    global _ramp_engine
+    if _ramp_engine is None:
+        _ramp_engine = DCRampEngine()
+    return _ramp_engine
+
+class RampedDCMotors(object):
+    """
+    Mixin for DC motor controllers that ramps speed changes.
+
+    It must come before DCMotorControllerBase in the base classes. Acceleration
+    and deceleration are in speed units (percent) per second. Without a ramp
+    speed changes are applied at once as before. Drivers that can write several
+    motors at once override _apply_speeds.
+    """
+    accel = None
+    decel = None
+
+    def set_ramp(self, accel=None, decel=None):
+        """
+        Set acceleration and deceleration of the motors of this controller.
+
+        :param accel: Speed increase per second, None changes speed at once.
+        :type accel: ``float``
+
+        :param decel: Speed decrease per second, defaults to accel.
+        :type decel: ``float``
+        """
+        self.accel = accel
+        self.decel = accel if decel is None else decel
+
+    @property
+    def _speeds(self):
+        speeds = self.__dict__.get("_current_speeds")
+        if speeds is None:
+            speeds = self._current_speeds = {}
+        return speeds
+
+    def input_changed(self, changed_input):
+        self.ramp_to(changed_input.index, changed_input.value)
+
+    def ramp_to(self, motor, speed):
+        """Change the speed of a motor along the ramp, returns a ``threading.Event`` that is set when it is reached."""
+        if not self.accel and not self.decel:
+            get_ramp_engine().cancel(self, motor)
+            self._write_speeds({motor: speed})
+            done = threading.Event()
+            done.set()
+            return done
+        return get_ramp_engine().ramp_to(self, motor, speed)
+
+    def _write_speeds(self, speeds):
+        self._speeds.update(speeds)
+        self._apply_speeds(speeds)
+
+    def _apply_speeds(self, speeds):
+        """Write new speeds, speeds is a dict of motor to speed."""
+        for motor, speed in iter(speeds.items()):
+            self._set_speed(motor, speed)
@@ -0,0 +1,88 @@
+# Copyright (c) 2017, Tim Wentzlau
+# Licensed under MIT
+
+"""
+Background thread shared by device drivers that poll a device or update it at
+a fixed rate.
+
+.. code:: python
+
+    thread = DeviceTickThread(device.update, 0.02)
+    thread.start_ticking()
+    ...
+    thread.stop_ticking()
+"""
+
+import time
+import threading
+from kervi.core.utility.thread import KerviThread
+from kervi.spine import Spine
+
+try:
+    clock = time.monotonic
+except AttributeError:
+    clock = time.time
+
+class DeviceTickThread(KerviThread):
+    """
+    Calls tick every interval seconds.
+
+    Ticks are scheduled against absolute deadlines so the time spent on the bus
+    inside tick does not accumulate as drift. If a tick overruns by more than a
+    whole interval the schedule is reset instead of firing a burst of catch up ticks.
+
+    stop_ticking pauses the thread and start_ticking resumes it, so a driver
+    keeps one thread for its lifetime. stop ends the thread, it is called
+    together with the other kervi threads.
+    """
+    def __init__(self, tick, interval):
+        KerviThread.__init__(self)
+        self._tick = tick
+        self.interval = interval
+        self._deadline = None
+        self._thread_started = False
+        self._wake = threading.Event()
+        self.alive = False
+        self.spine = Spine()
+        if self.spine:
+            self.spine.register_command_handler("stopThreads", self.stop)
+
+    def start_ticking(self):
+        """Start or resume ticking, the first tick is right away."""
+        if self.terminate or self.alive:
+            return
+        self.alive = True
+        self._wake.set()
+        if not self._thread_started:
+            self._thread_started = True
+            KerviThread.start(self)
+
+    def stop_ticking(self):
+        """Pause the thread after the current tick."""
+        self.alive = False
+
+    def stop(self):
+        """End the thread, it can not be started again."""
+        self.alive = False
+        KerviThread.stop(self)
+        self._wake.set()
+
+    def _step(self):
+        """Private method do not call it directly or override it."""
+        if not self.alive:
+            self._wake.wait()
+            self._wake.clear()
+            self._deadline = None
+            return
+        now = clock()
+        if self._deadline is None or now - self._deadline > self.interval:
+            self._deadline = now
+        try:
+            self._tick()
+        except:
+            if self.spine:
+                self.spine.log.exception("DeviceTickThread")
+        self._deadline += self.interval
+        delay = self._deadline - clock()
+        if delay > 0 and self.alive:
+            time.sleep(delay)
@@ -22,10 +22,13 @@
 from __future__ import division
 import time
 import math
-from kervi.hal import I2CGPIODeviceDriver, DeviceChannelOutOfBoundsError, DACValueOutOfBoundsError
+import threading
+from kervi.hal import I2CGPIODeviceDriver, DeviceChannelOutOfBoundsError, DACValueOutOfBoundsError, get_i2c
 from kervi.hal import ChannelPollingThread
 from kervi.core.utility.thread import KerviThread
 from kervi import spine
+from kervi.devices.batch import BatchWrites
+from kervi.devices.polling import DeviceTickThread
 
 import logging
 
@@ -37,6 +40,7 @@ MODE2              = 0x01
 SUBADR1            = 0x02
 SUBADR2            = 0x03
 SUBADR3            = 0x04
+ALLCALLADR         = 0x05
 PRESCALE           = 0xFE
 LED0_ON_L          = 0x06
 LED0_ON_H          = 0x07
@@ -49,41 +53,154 @@ ALL_LED_OFF_H      = 0xFD
 
 # Bits:
 RESTART            = 0x80
+AI                 = 0x20
 SLEEP              = 0x10
+SUB1               = 0x08
+SUB2               = 0x04
+SUB3               = 0x02
 ALLCALL            = 0x01
 INVRT              = 0x10
 OUTDRV             = 0x04
 
+NUM_CHANNELS       = 16
+# Max bytes in one i2c block write, bursts are split to fit.
+I2C_BLOCK_MAX      = 32
+CHANNELS_PER_BURST = I2C_BLOCK_MAX // 4
+
+# Power-on addresses of the ALLCALL and sub addresses
+ALLCALL_ADDRESS    = 0x70
+SUB_ADDRESSES      = {1: 0x71, 2: 0x72, 3: 0x74}
+_SUB_REGISTERS     = {1: (SUBADR1, SUB1), 2: (SUBADR2, SUB2), 3: (SUBADR3, SUB3)}
+
+# General call address and SWRST data byte
+GENERAL_CALL       = 0x00
+SWRST              = 0x06
+
 
 logger = logging.getLogger(__name__)
 
 
-def software_reset(i2c=None, **kwargs):
-    """Sends a software reset (SWRST) command to all servo drivers on the bus."""
+def software_reset(i2c=None, bus=None, **kwargs):
+    """Sends a software reset (SWRST) command to all servo drivers on the bus.
+    The chips return to their power-on state, drivers created before the reset
+    must be created again."""
     # Setup I2C interface for device 0x00 to talk to all of them.
-    #self.i2c.writeRaw8(0x06)  # SWRST
+    if i2c is None:
+        i2c = get_i2c(GENERAL_CALL, bus)
+    i2c.write_raw8(SWRST)
+
+def _pwm_bursts(channels, values):
+    """
+    Yield (register, data) for the bursts needed to write channels.
+
+    values holds the (on, off) of every channel, None where it is unknown.
+    Neighbouring channels and channels with a single known channel between them
+    are written in one burst of at most CHANNELS_PER_BURST channels.
+    """
+    channels = sorted(channels)
+    index = 0
+    while index < len(channels):
+        first = last = channels[index]
+        index += 1
+        while index < len(channels) and channels[index] - first < CHANNELS_PER_BURST:
+            gap = channels[index] - last
+            if gap > 2 or (gap == 2 and values[last + 1] is None):
+                break
+            last = channels[index]
+            index += 1
+        data = []
+        for channel in range(first, last + 1):
+            on, off = values[channel]
+            data += [on & 0xFF, on >> 8, off & 0xFF, off >> 8]
+        yield LED0_ON_L+4*first, data
+
+
+class PCA9685DeviceDriver(I2CGPIODeviceDriver, BatchWrites):
+    """PCA9685 PWM LED/servo controller."""
 
+    def __init__(self, address=PCA9685_ADDRESS, bus=None, gpio_id="PCA9685", frequency=None, adopt=False):
+        """
+        Initialize the PCA9685.
 
-class PCA9685DeviceDriver(I2CGPIODeviceDriver):
-    """PCA9685 PWM LED/servo controller."""
+        :param frequency:
+            If given the prescaler is set while the chip is asleep during initialization.
+
+        :type frequency: ``float``
 
-    def __init__(self, address=PCA9685_ADDRESS, bus=None, gpio_id="PCA9685"):
+        :param adopt:
+            If True a chip that is already running with auto-increment and totem pole
+            outputs is not reset, its register state is read back instead so outputs
+            keep their values across restarts of the application.
+
+        :type adopt: ``bool``
+
+        """
         I2CGPIODeviceDriver.__init__(self,address, bus, gpio_id)
-        """Initialize the PCA9685."""
+        BatchWrites.__init__(self)
+        self.address = address
+        self.bus = bus
+        # Prescale value written to the chip, None while unknown.
+        self._prescale = None
+        # Last (on, off) written to each channel, None while unknown.
+        self._pwm_shadow = [None] * NUM_CHANNELS
+        # Channel values set inside a batch, written when the batch ends.
+        self._pending_pwm = {}
+        self._pending_all_pwm = None
+        if adopt and self._adopt_state():
+            if frequency:
+                self.set_pwm_freq(frequency)
+        else:
+            self._initialize(frequency)
+
+    def _initialize(self, frequency):
         # Setup I2C interface for the device.
+        if frequency:
+            # PRESCALE can only be written while the oscillator is off.
+            self.i2c.write8(MODE1, ALLCALL | SLEEP)
+            self._write_prescale(self._get_prescale(frequency))
+        # Auto-increment lets each channel be written in one transaction,
+        # it must be enabled before the first multi byte write.
+        self.i2c.write8(MODE1, ALLCALL | AI)
         self.set_all_pwm(0, 0)
         self.i2c.write8(MODE2, OUTDRV)
-        self.i2c.write8(MODE1, ALLCALL)
-        time.sleep(0.005)  # wait for oscillator
+        # MODE1 was written with SLEEP cleared, only wait for the oscillator.
+        time.sleep(0.005)
+
+    def _adopt_state(self):
+        """Fill the shadow registers from a chip that is already configured.
+        Returns False if the chip needs to be initialized."""
         mode1 = self.i2c.read_U8(MODE1)
-        mode1 = mode1 & ~SLEEP  # wake up (reset sleep)
-        self.i2c.write8(MODE1, mode1)
-        time.sleep(0.005)  # wait for oscillator
+        if mode1 & (AI | SLEEP) != AI:
+            return False
+        # With auto-increment MODE1 to the last LED register is read in I2C_BLOCK_MAX sized bursts.
+        registers = []
+        last_register = LED0_ON_L + 4*NUM_CHANNELS
+        while len(registers) < last_register:
+            registers += list(self.i2c.read_list(len(registers), min(I2C_BLOCK_MAX, last_register - len(registers))))
+        if not registers[MODE2] & OUTDRV:
+            return False
+        for channel in range(NUM_CHANNELS):
+            on_l, on_h, off_l, off_h = registers[LED0_ON_L+4*channel:LED0_ON_L+4*channel+4]
+            self._pwm_shadow[channel] = (on_l | on_h << 8, off_l | off_h << 8)
+        self._prescale = self.i2c.read_U8(PRESCALE)
+        return True
 
     @property
     def device_name(self):
         return "PFC8591"
 
+    @property
+    def prescale(self):
+        """Prescale value written to the chip, None if it is not known."""
+        return self._prescale
+
+    @property
+    def frequency(self):
+        """Actual PWM frequency in hertz given the prescale value, None if it is not known."""
+        if self._prescale is None:
+            return None
+        return 25000000.0 / (4096.0 * (self._prescale + 1))
+
     def set(self, pin, value):
         if (pin < 0) or (pin > 15):
             raise NameError('PWM pin must be between 0 and 15 inclusive')
@@ -149,7 +266,20 @@ class PCA9685DeviceDriver(I2CGPIODeviceDriver):
         self.set_pwm(channel, 4096, 0)
 
     def set_pwm_freq(self, freq_hz):
-        """Set the PWM frequency to the provided value in hertz."""
+        """Set the PWM frequency to the provided value in hertz. Nothing is
+        written if the chip already runs with the resulting prescale value."""
+        prescale = self._get_prescale(freq_hz)
+        if prescale == self._prescale:
+            return
+        oldmode = self.i2c.read_U8(MODE1)
+        newmode = (oldmode & 0x7F) | 0x10    # sleep
+        self.i2c.write8(MODE1, newmode)  # go to sleep
+        self._write_prescale(prescale)
+        self.i2c.write8(MODE1, oldmode)
+        time.sleep(0.005)
+        self.i2c.write8(MODE1, oldmode | 0x80)
+
+    def _get_prescale(self, freq_hz):
         prescaleval = 25000000.0    # 25MHz
         prescaleval /= 4096.0       # 12-bit
         prescaleval /= float(freq_hz)
@@ -158,24 +288,295 @@ class PCA9685DeviceDriver(I2CGPIODeviceDriver):
         logger.debug('Estimated pre-scale: {0}'.format(prescaleval))
         prescale = int(math.floor(prescaleval + 0.5))
         logger.debug('Final pre-scale: {0}'.format(prescale))
-        oldmode = self.i2c.read_U8(MODE1)
-        newmode = (oldmode & 0x7F) | 0x10    # sleep
-        self.i2c.write8(MODE1, newmode)  # go to sleep
+        return prescale
+
+    def _write_prescale(self, prescale):
         self.i2c.write8(PRESCALE, prescale)
-        self.i2c.write8(MODE1, oldmode)
-        time.sleep(0.005)
-        self.i2c.write8(MODE1, oldmode | 0x80)
+        self._prescale = prescale
 
     def set_pwm(self, channel, on, off):
         """Sets a single PWM channel."""
-        self.i2c.write8(LED0_ON_L+4*channel, on & 0xFF)
-        self.i2c.write8(LED0_ON_H+4*channel, on >> 8)
-        self.i2c.write8(LED0_OFF_L+4*channel, off & 0xFF)
-        self.i2c.write8(LED0_OFF_H+4*channel, off >> 8)
+        self.set_pwm_many({channel: (on, off)})
+
+    def set_pwm_many(self, channels):
+        """
+        Sets multiple PWM channels.
+
+        Channels that already hold the value are skipped and runs of neighbouring
+        channels are written as one auto-increment burst.
+
+        :param channels: Dict of channel to (on, off) tuple.
+        :type channels: ``dict``
+        """
+        with self._write_lock:
+            if self.batching:
+                self._pending_pwm.update(channels)
+                return
+            values = list(self._pwm_shadow)
+            dirty = []
+            for channel, value in iter(channels.items()):
+                if values[channel] != value:
+                    values[channel] = value
+                    dirty.append(channel)
+            self._write_pwm_channels(dirty, values)
+
+    def update_all(self, frame, force=False):
+        """
+        Sets all channels from a frame of 16 (on, off) tuples, None leaves a channel as is.
+        Only changed channels are written unless force is True, then the whole
+        frame is written in NUM_CHANNELS / CHANNELS_PER_BURST bursts.
+        """
+        channels = dict((channel, value) for channel, value in enumerate(frame) if value is not None)
+        with self._write_lock:
+            if force:
+                for channel in channels:
+                    self._pwm_shadow[channel] = None
+            self.set_pwm_many(channels)
+
+    def _write_pwm_channels(self, channels, values):
+        """Write values of channels in as few bursts as possible. The shadow
+        is updated after each burst, so channels of a failed write are retried."""
+        for register, data in _pwm_bursts(channels, values):
+            self.i2c.write_list(register, data)
+            first = (register - LED0_ON_L) // 4
+            for channel in range(first, first + len(data) // 4):
+                self._pwm_shadow[channel] = values[channel]
+
+    def set_sub_address(self, sub_address, address=None, enabled=True):
+        """
+        Configure one of the three sub addresses the chip also responds to,
+        used to address groups of boards with ``PCA9685Group``.
+
+        :param sub_address: 1, 2 or 3.
+        :param address: 7 bit i2c address, default is the power-on address of the sub address.
+        :param enabled: Respond to the sub address.
+        """
+        register, bit = _SUB_REGISTERS[sub_address]
+        if address is None:
+            address = SUB_ADDRESSES[sub_address]
+        self.i2c.write8(register, address << 1)
+        mode1 = self.i2c.read_U8(MODE1) & ~RESTART
+        if enabled:
+            mode1 |= bit
+        else:
+            mode1 &= ~bit
+        self.i2c.write8(MODE1, mode1)
 
     def set_all_pwm(self, on, off):
         """Sets all PWM channels."""
-        self.i2c.write8(ALL_LED_ON_L, on & 0xFF)
-        self.i2c.write8(ALL_LED_ON_H, on >> 8)
-        self.i2c.write8(ALL_LED_OFF_L, off & 0xFF)
-        self.i2c.write8(ALL_LED_OFF_H, off >> 8)
\ No newline at end of file
+        with self._write_lock:
+            if self.batching:
+                self._pending_pwm = {}
+                self._pending_all_pwm = (on, off)
+                return
+            self.i2c.write_list(ALL_LED_ON_L, [on & 0xFF, on >> 8, off & 0xFF, off >> 8])
+            self._pwm_shadow = [(on, off)] * NUM_CHANNELS
+
+    def _flush_writes(self):
+        with self._write_lock:
+            pending_all = self._pending_all_pwm
+            pending = self._pending_pwm
+            self._pending_all_pwm = None
+            self._pending_pwm = {}
+            if pending_all:
+                self.set_all_pwm(*pending_all)
+            self.set_pwm_many(pending)
+
+class PCA9685Group(object):
+    """
+    Writes to many PCA9685 boards at once via the ALLCALL address or a sub address.
+
+    Every write is one transaction on the bus no matter how many boards are in
+    the group. The shadow registers of the member boards are updated so later
+    writes to a single board are still suppressed correctly.
+
+    .. code:: python
+
+        # boards respond to 0x71 via SUBADR1
+        lights = PCA9685Group([board1, board2, board3], address=0x71, sub_address=1)
+        lights.set_all_pwm(0, 4096) # blackout
+    """
+    def __init__(self, boards, address=ALLCALL_ADDRESS, sub_address=None, bus=None):
+        """
+        :param boards: The PCA9685DeviceDriver boards that respond to address.
+        :param address: Broadcast address, default is ALLCALL.
+        :param sub_address: If 1, 2 or 3 the boards are configured to respond to address on that sub address.
+        """
+        self.boards = list(boards)
+        self.address = address
+        if sub_address:
+            for board in self.boards:
+                board.set_sub_address(sub_address, address)
+        self.i2c = get_i2c(address, bus)
+
+    def set_pwm(self, channel, on, off):
+        """Sets a PWM channel on all boards."""
+        self.set_pwm_many({channel: (on, off)})
+
+    def set_pwm_many(self, channels):
+        """Sets multiple PWM channels on all boards, channels should be a dict of channel to (on, off).
+        Channels that all boards already hold are skipped."""
+        values = [None] * NUM_CHANNELS
+        for channel in range(NUM_CHANNELS):
+            value = self.boards[0]._pwm_shadow[channel] if self.boards else None
+            for board in self.boards:
+                if board._pwm_shadow[channel] != value:
+                    value = None
+                    break
+            values[channel] = value
+        dirty = []
+        for channel, value in iter(channels.items()):
+            if values[channel] != value:
+                values[channel] = value
+                dirty.append(channel)
+        for register, data in _pwm_bursts(dirty, values):
+            self.i2c.write_list(register, data)
+        for board in self.boards:
+            with board._write_lock:
+                for channel in dirty:
+                    board._pwm_shadow[channel] = values[channel]
+
+    def set_all_pwm(self, on, off):
+        """Sets all channels on all boards in one transaction."""
+        self.i2c.write_list(ALL_LED_ON_L, [on & 0xFF, on >> 8, off & 0xFF, off >> 8])
+        for board in self.boards:
+            with board._write_lock:
+                board._pwm_shadow = [(on, off)] * NUM_CHANNELS
+
+class _BusFlushThread(KerviThread):
+    """Flushes the boards of one bus when the channel space ticks, ends on stopThreads."""
+    def __init__(self, flush):
+        KerviThread.__init__(self)
+        self.name = "PCA9685BusFlush"
+        self._flush = flush
+        self.work = None
+        self.error = None
+        self.go = threading.Event()
+        self.done = threading.Event()
+        self.spine = spine.Spine()
+        if self.spine:
+            self.spine.register_command_handler("stopThreads", self.stop)
+
+    def stop(self):
+        KerviThread.stop(self)
+        self.go.set()
+
+    def _step(self):
+        self.go.wait()
+        self.go.clear()
+        if self.terminate:
+            return
+        try:
+            self._flush(self.work)
+        except Exception as error:
+            logger.exception("PCA9685 bus flush failed")
+            self.error = error
+        finally:
+            self.done.set()
+
+class PCA9685ChannelSpace(object):
+    """
+    Many PCA9685 boards addressed as one device with a global channel index,
+    channel 0-15 is the first board, 16-31 the second and so on.
+
+    Updates are buffered and flushed every interval seconds. Each dirty board
+    is written with one set_pwm_many call, so changed neighbouring channels go
+    out as bursts. Boards on different buses are flushed in parallel.
+
+    .. code:: python
+
+        channels = PCA9685ChannelSpace.from_addresses(range(0x40, 0x46), frequency=1000)
+        channels.set_pwm_many({0: (0, 2048), 17: (0, 1024), 95: (0, 4096)})
+    """
+    def __init__(self, boards, interval=0.02):
+        self.boards = list(boards)
+        self.interval = interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._bus_threads = {}
+
+    @classmethod
+    def from_addresses(cls, addresses, bus=None, interval=0.02, **kwargs):
+        """Create a channel space from board addresses, kwargs are passed to each PCA9685DeviceDriver."""
+        return cls([PCA9685DeviceDriver(address, bus, **kwargs) for address in addresses], interval)
+
+    @property
+    def num_channels(self):
+        return len(self.boards) * NUM_CHANNELS
+
+    def get_board(self, channel):
+        """Return (board, board channel) for a global channel."""
+        if channel < 0 or channel >= self.num_channels:
+            raise DeviceChannelOutOfBoundsError("PCA9685ChannelSpace", channel)
+        return self.boards[channel // NUM_CHANNELS], channel % NUM_CHANNELS
+
+    def set_pwm(self, channel, on, off):
+        """Buffer a new value for a global channel."""
+        self.set_pwm_many({channel: (on, off)})
+
+    def set_pwm_many(self, channels):
+        """Buffer new values for global channels, channels is a dict of channel to (on, off)."""
+        with self._lock:
+            for channel, value in iter(channels.items()):
+                board, board_channel = self.get_board(channel)
+                self._pending.setdefault(board, {})[board_channel] = value
+            if self._thread is None or not self._thread.alive:
+                self._thread = DeviceTickThread(self.flush, self.interval)
+                self._thread.start_ticking()
+
+    def flush(self):
+        """
+        Write all buffered values now. A bus error is raised after all buses are
+        flushed, the values of the failed buses stay buffered for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+            if not pending:
+                return
+            buses = {}
+            for board, channels in iter(pending.items()):
+                buses.setdefault(board.bus, []).append((board, channels))
+            work = list(buses.items())
+            started = []
+            for bus, boards in work[1:]:
+                bus_thread = self._bus_threads.get(bus)
+                if bus_thread is None or not bus_thread.is_alive():
+                    bus_thread = self._bus_threads[bus] = _BusFlushThread(self._flush_boards)
+                    bus_thread.start()
+                bus_thread.work = boards
+                bus_thread.error = None
+                bus_thread.done.clear()
+                bus_thread.go.set()
+                started.append(bus_thread)
+            error = None
+            try:
+                self._flush_boards(work[0][1])
+            except Exception as bus_error:
+                error = bus_error
+                self._requeue(work[0][1])
+            for bus_thread in started:
+                while not bus_thread.done.wait(self.interval):
+                    if not bus_thread.is_alive():
+                        break
+                if bus_thread.error or not bus_thread.done.is_set():
+                    self._requeue(bus_thread.work)
+                error = error or bus_thread.error
+            if error:
+                raise error
+
+    def _requeue(self, boards):
+        """Buffer the values of boards that failed again, newer values win."""
+        with self._lock:
+            for board, channels in boards:
+                pending = self._pending.setdefault(board, {})
+                for channel, value in iter(channels.items()):
+                    pending.setdefault(channel, value)
+
+    @staticmethod
+    def _flush_boards(boards):
+        for board, channels in boards:
+            board.set_pwm_many(channels)
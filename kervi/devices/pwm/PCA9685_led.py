@@ -0,0 +1,135 @@
+# Copyright (c) 2017, Tim Wentzlau
+# Licensed under MIT
+
+"""
+LED dimming on top of the PCA9685 driver.
+
+.. code:: python
+
+    pwm = PCA9685DeviceDriver(0x40)
+    leds = LEDFader(pwm)
+    leds.fade({0: 1.0, 1: 0.5, 2: 0.0}, 2.0)
+"""
+
+import threading
+from kervi.devices.polling import DeviceTickThread, clock
+
+PWM_MAX = 4095
+
+def gamma_table(gamma=2.2, size=PWM_MAX + 1):
+    """Return a table that maps size linear brightness levels to 12 bit pwm counts."""
+    return [int(round(PWM_MAX * (level / float(size - 1)) ** gamma)) for level in range(size)]
+
+GAMMA_TABLE = gamma_table()
+
+class _Fade(object):
+    def __init__(self, start_time, duration, start, target, done):
+        self.start_time = start_time
+        self.duration = duration
+        self.start = start
+        self.target = target
+        self.done = done
+
+class LEDFader(object):
+    """
+    Gamma corrected brightness and fades for LEDs on a PCA9685.
+
+    Brightness is given from 0.0 to 1.0 and mapped through a precomputed gamma
+    table to pwm counts. Fades are interpolated by one background thread that
+    writes all changed channels of a tick with one call to set_pwm_many.
+    The thread only runs while fades are active.
+    """
+    def __init__(self, device, interval=0.02, table=None):
+        self.device = device
+        self.interval = interval
+        self.table = table or GAMMA_TABLE
+        self._levels = len(self.table) - 1
+        self._brightness = {}
+        self._fades = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _pwm_value(self, brightness):
+        count = self.table[int(max(0.0, min(1.0, brightness)) * self._levels + 0.5)]
+        if count <= 0:
+            return (0, 4096)
+        if count >= PWM_MAX:
+            return (4096, 0)
+        return (0, count)
+
+    def get_brightness(self, channel):
+        """Return the current brightness of channel, None if it was never set."""
+        return self._brightness.get(channel)
+
+    def set_brightness(self, channels):
+        """Set brightness of channels now, channels is a dict of channel to brightness.
+        Fades running on the channels are stopped."""
+        # hold the device like _tick does, so a running tick can not write
+        # its fade value over the new brightness
+        with self.device.batch():
+            with self._lock:
+                for channel, brightness in iter(channels.items()):
+                    self._cancel_fade(channel)
+                    self._brightness[channel] = brightness
+            self.device.set_pwm_many(
+                dict((channel, self._pwm_value(brightness)) for channel, brightness in channels.items())
+            )
+
+    def fade(self, targets, duration):
+        """
+        Fade channels from their current brightness to new targets.
+
+        :param targets: Dict of channel to target brightness from 0.0 to 1.0.
+        :type targets: ``dict``
+
+        :param duration: Fade time in seconds.
+        :type duration: ``float``
+
+        :return: ``threading.Event`` that is set when the fade is done.
+        """
+        done = threading.Event()
+        with self._lock:
+            start_time = clock()
+            for channel, target in iter(targets.items()):
+                self._cancel_fade(channel)
+                start = self._brightness.get(channel, 0.0)
+                self._fades[channel] = _Fade(start_time, duration, start, target, done)
+            if not targets:
+                done.set()
+            else:
+                if self._thread is None:
+                    self._thread = DeviceTickThread(self._tick, self.interval)
+                self._thread.start_ticking()
+        return done
+
+    def _cancel_fade(self, channel):
+        fade = self._fades.pop(channel, None)
+        if fade and not [other for other in self._fades.values() if other.done is fade.done]:
+            fade.done.set()
+
+    def _tick(self):
+        now = clock()
+        finished = []
+        # hold the device while fades are computed and written, so a
+        # set_brightness from another thread lands before or after this tick
+        with self.device.batch():
+            updates = {}
+            with self._lock:
+                for channel, fade in list(self._fades.items()):
+                    elapsed = now - fade.start_time
+                    if elapsed >= fade.duration:
+                        brightness = fade.target
+                        del self._fades[channel]
+                        finished.append(fade.done)
+                    else:
+                        brightness = fade.start + (fade.target - fade.start) * elapsed / fade.duration
+                    self._brightness[channel] = brightness
+                    updates[channel] = self._pwm_value(brightness)
+                if not self._fades:
+                    self._thread.stop_ticking()
+                pending = set(fade.done for fade in self._fades.values())
+            if updates:
+                self.device.set_pwm_many(updates)
+        for done in finished:
+            if done not in pending:
+                done.set()